@@ -5,16 +5,31 @@ import os
 import time
 import re
 import json
-from datetime import datetime
+import random
+import queue
+import threading
+import heapq
+import functools
+import multiprocessing
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
+from telegram.helpers import escape_markdown
+from telegram.error import RetryAfter, Forbidden, BadRequest
 import sqlite3
-import requests
-from bs4 import BeautifulSoup
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+import aiohttp
 from dotenv import load_dotenv
+from parsing import (
+    decode_json, slice_hydration_json, iter_hydration_items,
+    parse_html_payload, parse_json_videos_payload, parse_item_list_payload
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -34,241 +49,887 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', '1800'))
 DB_PATH = os.getenv('DB_PATH', 'database/tiktok_bot.db')
 
+# Настройки SQLite
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))
+DB_STATS_WINDOW = int(os.getenv('DB_STATS_WINDOW', '500'))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '8192'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+SEEN_INDEX_MAX_VIDEOS = int(os.getenv('SEEN_INDEX_MAX_VIDEOS', '200000'))
+READ_CACHE_SIZE = int(os.getenv('READ_CACHE_SIZE', '5000'))
+READ_CACHE_TTL = int(os.getenv('READ_CACHE_TTL', '300'))
+
+# Настройки HTTP-клиента
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '15'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '4'))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+
+# Ограничение частоты запросов к каждому хосту и автомат отключения
+RATE_LIMIT_RPS = float(os.getenv('RATE_LIMIT_RPS', '0.5'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '3'))
+RATE_LIMIT_DEFAULT_BACKOFF = int(os.getenv('RATE_LIMIT_DEFAULT_BACKOFF', '10'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '60'))
+BREAKER_COOLDOWN = int(os.getenv('BREAKER_COOLDOWN', '300'))
+
+# Настройки параллельной проверки
+CHECK_CONCURRENCY = int(os.getenv('CHECK_CONCURRENCY', '5'))
+SONG_CHECK_TIMEOUT = float(os.getenv('SONG_CHECK_TIMEOUT', '120'))
+SOURCE_CONCURRENCY = {
+    'public_api': int(os.getenv('PUBLIC_API_CONCURRENCY', '3')),
+    'web_scraping': int(os.getenv('WEB_SCRAPING_CONCURRENCY', '2')),
+    'rapidapi': int(os.getenv('RAPIDAPI_CONCURRENCY', '3')),
+}
+
+# Настройки адаптивного расписания проверок (секунды)
+POLL_MIN_INTERVAL = int(os.getenv('POLL_MIN_INTERVAL', '300'))
+POLL_MAX_INTERVAL = int(os.getenv('POLL_MAX_INTERVAL', '86400'))
+POLL_BACKOFF_FACTOR = float(os.getenv('POLL_BACKOFF_FACTOR', '2'))
+POLL_TARGET_NEW_VIDEOS = float(os.getenv('POLL_TARGET_NEW_VIDEOS', '5'))
+POLL_ACTIVITY_WINDOW = int(os.getenv('POLL_ACTIVITY_WINDOW', '172800'))
+POLL_JITTER = float(os.getenv('POLL_JITTER', '0.1'))
+CHECK_MIN_PAUSE = int(os.getenv('CHECK_MIN_PAUSE', '30'))
+
+# Настройки сводных уведомлений
+DIGEST_MAX_VIDEOS_PER_SONG = int(os.getenv('DIGEST_MAX_VIDEOS_PER_SONG', '5'))
+DIGEST_MESSAGE_LIMIT = 4000  # запас до лимита Telegram в 4096 символов
+DIGEST_WINDOW = int(os.getenv('DIGEST_WINDOW', '900'))  # сколько копить уведомления пользователя до сводки
+
+# Очередь исходящих уведомлений
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+OUTBOX_POLL_INTERVAL = int(os.getenv('OUTBOX_POLL_INTERVAL', '60'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+TELEGRAM_GLOBAL_RPS = float(os.getenv('TELEGRAM_GLOBAL_RPS', '25'))
+TELEGRAM_CHAT_RPS = float(os.getenv('TELEGRAM_CHAT_RPS', '1'))
+
+# Кэш ответов для условных запросов (число URL)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+
+# Гонка источников: задержка старта запасных и достаточное число видео
+SOURCE_HEDGE_DELAY = float(os.getenv('SOURCE_HEDGE_DELAY', '3'))
+SOURCE_ENOUGH_VIDEOS = int(os.getenv('SOURCE_ENOUGH_VIDEOS', '10'))
+
+# Учет здоровья эндпоинтов
+ENDPOINT_STATS_WINDOW = int(os.getenv('ENDPOINT_STATS_WINDOW', '50'))
+ENDPOINT_DEAD_AFTER = int(os.getenv('ENDPOINT_DEAD_AFTER', '5'))
+ENDPOINT_PROBE_INTERVAL = int(os.getenv('ENDPOINT_PROBE_INTERVAL', '1800'))
+
+# Пул разбора страниц: thread или process; маленькие ответы разбираются на месте.
+# В потоках event loop не блокируется: parsing сканирует HTML окнами. Процессы
+# spawn все равно исполняют main.py как __mp_main__ (telegram, aiohttp, логгер) —
+# при лимите памяти 512Mi включать только осознанно
+PARSE_POOL = os.getenv('PARSE_POOL', 'thread')
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', '2'))
+PARSE_INLINE_MAX_BYTES = int(os.getenv('PARSE_INLINE_MAX_BYTES', str(32 * 1024)))
+
+# Срок хранения разрешенных коротких ссылок (секунды)
+LINK_CACHE_TTL = int(os.getenv('LINK_CACHE_TTL', str(30 * 86400)))
+
+# Видео на одной странице просмотра
+VIDEOS_PAGE_SIZE = int(os.getenv('VIDEOS_PAGE_SIZE', '10'))
+
+# Постраничный обход списка видео звука
+CRAWL_PAGE_SIZE = int(os.getenv('CRAWL_PAGE_SIZE', '30'))
+CRAWL_MAX_PAGES = int(os.getenv('CRAWL_MAX_PAGES', '5'))
+
 # ========== БАЗА ДАННЫХ ==========
 
+class Database:
+    """Долгоживущие соединения SQLite: один сериализованный писатель и пул читателей"""
+
+    def __init__(self, path, read_pool_size=4):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        self._write_conn = None
+        self._write_lock = threading.Lock()
+        self._readers = queue.Queue()
+        self._readers_created = 0
+        self._readers_lock = threading.Lock()
+        # Отдельные пулы потоков: запросы обработчиков не стоят в очереди за проверкой
+        self._executors = {}
+        self._pending = {'interactive': 0, 'background': 0}
+        self._latencies = {lane: deque(maxlen=DB_STATS_WINDOW) for lane in self._pending}
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA busy_timeout = 30000')
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Единственное соединение на запись; транзакция фиксируется при выходе"""
+        with self._write_lock:
+            if self._write_conn is None:
+                self._write_conn = self._connect()
+            conn = self._write_conn
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """Соединение на чтение из пула"""
+        conn = None
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._readers_lock:
+                if self._readers_created < self.read_pool_size:
+                    self._readers_created += 1
+                    try:
+                        conn = self._connect()
+                    except Exception:
+                        self._readers_created -= 1
+                        raise
+        if conn is None:
+            conn = self._readers.get()
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def _executor(self, lane):
+        if lane not in self._executors:
+            workers = self.read_pool_size if lane == 'interactive' else 1
+            self._executors[lane] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'db-{lane}')
+        return self._executors[lane]
+
+    async def run(self, func, *args, background=False, **kwargs):
+        """Асинхронный вызов синхронной функции БД в пуле потоков.
+
+        background=True — для периодической проверки и очереди уведомлений:
+        у них свой поток, чтобы обработчики кнопок не ждали за ними.
+        """
+        lane = 'background' if background else 'interactive'
+        loop = asyncio.get_running_loop()
+        self._pending[lane] += 1
+        started = time.monotonic()
+        try:
+            return await loop.run_in_executor(self._executor(lane), functools.partial(func, *args, **kwargs))
+        finally:
+            self._pending[lane] -= 1
+            self._latencies[lane].append(time.monotonic() - started)
+
+    def stats(self):
+        """Глубина очереди и задержка запросов (с ожиданием в очереди) по пулам"""
+        parts = []
+        for lane, latencies in self._latencies.items():
+            ordered = sorted(latencies)
+            p50 = ordered[len(ordered) // 2] * 1000 if ordered else 0.0
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000 if ordered else 0.0
+            parts.append(f"{lane}: в очереди {self._pending[lane]}, p50 {p50:.1f} мс, p95 {p95:.1f} мс")
+        return '; '.join(parts)
+
+    def close(self):
+        """Закрытие всех соединений"""
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+        self._executors = {}
+        with self._write_lock:
+            if self._write_conn is not None:
+                self._write_conn.close()
+                self._write_conn = None
+        with self._readers_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._readers_created = 0
+
+db = Database(DB_PATH, DB_READ_POOL_SIZE)
+
+VIDEO_ID_PATTERN = re.compile(r'/video/(\d+)')
+
+class SeenVideoIndex:
+    """Известные видео по каждому звуку в памяти.
+
+    Хранит ID видео (int) в множествах по звукам, чтобы частый случай
+    «видео уже видели» не обращался к БД. Индекс — только кэш: отсутствие
+    ключа не означает, что видео новое, окончательно решает INSERT OR IGNORE.
+    Число ключей ограничено max_entries, лишние звуки вытесняются (LRU).
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._songs = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def video_key(video_url):
+        match = VIDEO_ID_PATTERN.search(video_url)
+        return int(match.group(1)) if match else video_url
+
+    def contains(self, song_id, video_url):
+        with self._lock:
+            keys = self._songs.get(song_id)
+            if keys is None:
+                return False
+            self._songs.move_to_end(song_id)
+            return self.video_key(video_url) in keys
+
+    def add(self, song_id, video_urls):
+        with self._lock:
+            keys = self._songs.get(song_id)
+            if keys is None:
+                keys = self._songs[song_id] = set()
+            self._songs.move_to_end(song_id)
+            
+            before = len(keys)
+            keys.update(self.video_key(url) for url in video_urls)
+            self._size += len(keys) - before
+            
+            # Вытесняем давно не использованные звуки, но не текущий
+            while self._size > self.max_entries and len(self._songs) > 1:
+                _, evicted = self._songs.popitem(last=False)
+                self._size -= len(evicted)
+
+    def discard_song(self, song_id):
+        with self._lock:
+            keys = self._songs.pop(song_id, None)
+            if keys is not None:
+                self._size -= len(keys)
+
+    def warm(self):
+        """Заполнение индекса из таблицы videos (сначала самые свежие)"""
+        try:
+            with db.reader() as conn:
+                rows = conn.execute('SELECT song_id, video_url FROM videos ORDER BY id DESC LIMIT ?', (self.max_entries,))
+                by_song = {}
+                for song_id, video_url in rows:
+                    by_song.setdefault(song_id, []).append(video_url)
+            
+            for song_id, video_urls in by_song.items():
+                self.add(song_id, video_urls)
+            
+            logger.info(f"🧠 Индекс видео загружен: {self.stats()}")
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки индекса видео: {e}")
+
+    # Оценка памяти по счетчикам: пустое множество, ID видео (int до 2^63)
+    # и слот хеш-таблицы множества (16 байт, таблица заполнена не больше чем на 60%)
+    _SET_BYTES = sys.getsizeof(set())
+    _KEY_BYTES = sys.getsizeof(2 ** 62) + 32
+
+    def memory_usage(self):
+        """Оценка занимаемой памяти в байтах (без обхода ключей)"""
+        with self._lock:
+            songs, size = len(self._songs), self._size
+            songs_bytes = sys.getsizeof(self._songs)
+        return songs_bytes + songs * self._SET_BYTES + size * self._KEY_BYTES
+
+    def stats(self):
+        return f"звуков {len(self._songs)}, видео {self._size}/{self.max_entries}, ~{self.memory_usage() / 1024 / 1024:.1f} МБ"
+
+seen_videos = SeenVideoIndex(SEEN_INDEX_MAX_VIDEOS)
+
+class ReadCache:
+    """Кэш чтения для меню: LRU с TTL и точной инвалидацией по тегам.
+
+    Каждая запись помечена тегами ('user', user_id) и ('track', tracked_song_id);
+    запись в БД сбрасывает только записи с затронутыми тегами. Если во время
+    загрузки прошла инвалидация, результат не сохраняется — в кэш не попадет
+    состояние, прочитанное до фиксации транзакции.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load, tags):
+        """Значение из кэша или load(); tags — список тегов либо функция от значения"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        
+        value = load()
+        entry_tags = tags(value) if callable(tags) else tags
+        
+        with self._lock:
+            if generation == self._generation:
+                self._drop(key)
+                self._entries[key] = (time.monotonic() + self.ttl, value, entry_tags)
+                for tag in entry_tags:
+                    self._tags.setdefault(tag, set()).add(key)
+                while len(self._entries) > self.max_entries:
+                    self._drop(next(iter(self._entries)))
+        return value
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for tag in entry[2]:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def invalidate(self, *tags):
+        """Сброс всех записей с любым из тегов"""
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._drop(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return f"записей {len(self._entries)}/{self.max_entries}, попаданий {self.hits}, промахов {self.misses} ({ratio:.0f}%)"
+
+read_cache = ReadCache(READ_CACHE_SIZE, READ_CACHE_TTL)
+
 def init_db():
     """Инициализация базы данных"""
     try:
-        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS songs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            song_url TEXT NOT NULL UNIQUE,
-            song_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_checked TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS videos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            song_id INTEGER NOT NULL,
-            video_url TEXT NOT NULL UNIQUE,
-            description TEXT,
-            author_username TEXT,
-            author_name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            tiktok_created_at TIMESTAMP,
-            FOREIGN KEY (song_id) REFERENCES songs (id)
-        )
-        ''')
-        
-        # Индексы для производительности
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_songs_user_id ON songs (user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_songs_song_id ON songs (song_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_song_id ON videos (song_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_created ON videos (tiktok_created_at)')
+        with db.writer() as conn:
+            cursor = conn.cursor()
+            
+            # Отслеживаемые звуки TikTok: одна строка на song_id независимо от числа подписчиков
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tracked_songs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                song_id TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
+                song_url TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_checked TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+            
+            # Подписки пользователей на звуки
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                tracked_song_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                song_url TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (user_id, tracked_song_id),
+                FOREIGN KEY (tracked_song_id) REFERENCES tracked_songs (id)
+            )
+            ''')
+            
+            # videos.song_id ссылается на tracked_songs.id
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS videos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                song_id INTEGER NOT NULL,
+                video_url TEXT NOT NULL UNIQUE,
+                description TEXT,
+                author_username TEXT,
+                author_name TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                tiktok_created_at TIMESTAMP,
+                FOREIGN KEY (song_id) REFERENCES tracked_songs (id)
+            )
+            ''')
+            
+            # Исходящие уведомления пишутся в одной транзакции с новыми видео
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notifications_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                subscription_id INTEGER NOT NULL,
+                video_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                delivered_at TIMESTAMP,
+                UNIQUE (user_id, video_id)
+            )
+            ''')
+            
+            # Короткие ссылки и ссылки на видео → канонический URL звука
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS resolved_links (
+                link TEXT PRIMARY KEY,
+                canonical_url TEXT NOT NULL,
+                song_id TEXT NOT NULL,
+                song_name TEXT NOT NULL,
+                resolved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+            
+            migrate_legacy_songs(cursor)
+            ensure_column(cursor, 'tracked_songs', 'poll_interval', 'INTEGER')
+            ensure_column(cursor, 'tracked_songs', 'high_water_mark', 'TEXT')
+            
+            # Число видео звука поддерживается триггерами — список песен читается без COUNT(*)
+            if ensure_column(cursor, 'tracked_songs', 'video_count', 'INTEGER NOT NULL DEFAULT 0'):
+                cursor.execute('UPDATE tracked_songs SET video_count = (SELECT COUNT(*) FROM videos v WHERE v.song_id = tracked_songs.id)')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_videos_count_insert AFTER INSERT ON videos
+            BEGIN
+                UPDATE tracked_songs SET video_count = video_count + 1 WHERE id = NEW.song_id;
+            END
+            ''')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_videos_count_delete AFTER DELETE ON videos
+            BEGIN
+                UPDATE tracked_songs SET video_count = video_count - 1 WHERE id = OLD.song_id;
+            END
+            ''')
+            
+            # Индексы для производительности
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions (user_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_tracked ON subscriptions (tracked_song_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_song_id ON videos (song_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_created ON videos (tiktok_created_at)')
+            # (song_id, created_at, id) — и для подсчета активности, и для постраничного просмотра
+            cursor.execute('DROP INDEX IF EXISTS idx_videos_song_created')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_song_created_id ON videos (song_id, created_at, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notifications_outbox (status, next_attempt_at)')
         
-        conn.commit()
-        conn.close()
         logger.info("✅ База данных инициализирована")
         
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
 
-def add_song(user_id, name, song_url, song_id):
-    """Добавление песни в базу"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
+def ensure_column(cursor, table, column, definition):
+    """Добавление колонки в существующую таблицу, если ее еще нет; True, если добавлена"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column in (row[1] for row in cursor.fetchall()):
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def migrate_legacy_songs(cursor):
+    """Перенос старой таблицы songs (одна строка на пользователя) в tracked_songs + subscriptions"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'songs'")
+    if cursor.fetchone() is None:
+        return
+    
+    cursor.execute('SELECT id, user_id, name, song_url, song_id, created_at, last_checked FROM songs')
+    legacy_songs = cursor.fetchall()
+    
+    for legacy_id, user_id, name, song_url, song_id, created_at, last_checked in legacy_songs:
+        song_id = song_id or song_url
         cursor.execute(
-            'INSERT OR IGNORE INTO songs (user_id, name, song_url, song_id) VALUES (?, ?, ?, ?)',
-            (user_id, name, song_url, song_id)
+            '''INSERT OR IGNORE INTO tracked_songs (song_id, name, song_url, created_at, last_checked)
+               VALUES (?, ?, ?, ?, ?)''',
+            (song_id, name, song_url, created_at, last_checked)
         )
+        cursor.execute('SELECT id FROM tracked_songs WHERE song_id = ?', (song_id,))
+        tracked_song_id = cursor.fetchone()[0]
         
-        conn.commit()
-        
-        # Получаем ID
+        # Сохраняем id, чтобы старые кнопки в чатах продолжали работать
         cursor.execute(
-            'SELECT id FROM songs WHERE song_url = ? AND user_id = ?',
-            (song_url, user_id)
+            '''INSERT OR IGNORE INTO subscriptions (id, user_id, tracked_song_id, name, song_url, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (legacy_id, user_id, tracked_song_id, name, song_url, created_at)
         )
-        result = cursor.fetchone()
-        song_db_id = result[0] if result else None
-        
-        conn.close()
+        cursor.execute('UPDATE videos SET song_id = ? WHERE song_id = ?', (tracked_song_id, legacy_id))
+    
+    cursor.execute('ALTER TABLE songs RENAME TO songs_legacy')
+    logger.info(f"✅ Миграция песен завершена: перенесено {len(legacy_songs)} подписок")
+
+def add_song(user_id, name, song_url, song_id):
+    """Подписка пользователя на песню (звук создается один раз на song_id)"""
+    try:
+        with db.writer() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'INSERT OR IGNORE INTO tracked_songs (song_id, name, song_url) VALUES (?, ?, ?)',
+                (song_id, name, song_url)
+            )
+            cursor.execute('SELECT id FROM tracked_songs WHERE song_id = ?', (song_id,))
+            tracked_song_id = cursor.fetchone()[0]
+            
+            cursor.execute(
+                'INSERT OR IGNORE INTO subscriptions (user_id, tracked_song_id, name, song_url) VALUES (?, ?, ?, ?)',
+                (user_id, tracked_song_id, name, song_url)
+            )
+            is_new = cursor.rowcount > 0
+            
+            # Получаем ID подписки
+            cursor.execute(
+                'SELECT id FROM subscriptions WHERE user_id = ? AND tracked_song_id = ?',
+                (user_id, tracked_song_id)
+            )
+            result = cursor.fetchone()
+            song_db_id = result[0] if result else None
         
-        is_new = cursor.rowcount > 0
-        return song_db_id, is_new
+        read_cache.invalidate(('user', user_id))
+        return song_db_id, tracked_song_id, is_new
         
     except Exception as e:
         logger.error(f"❌ Ошибка добавления песни: {e}")
-        return None, False
+        return None, None, False
 
 def get_user_songs(user_id):
-    """Получение песен пользователя"""
+    """Получение песен пользователя (через кэш чтения)"""
+    def load():
+        with db.reader() as conn:
+            return conn.execute(
+                '''SELECT s.id, s.name, s.song_url, t.song_id, s.created_at, t.last_checked, t.id, t.video_count
+                   FROM subscriptions s
+                   JOIN tracked_songs t ON s.tracked_song_id = t.id
+                   WHERE s.user_id = ?
+                   ORDER BY s.created_at DESC''',
+                (user_id,)
+            ).fetchall()
+    
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            'SELECT id, name, song_url, song_id, created_at, last_checked FROM songs WHERE user_id = ? ORDER BY created_at DESC',
-            (user_id,)
+        return read_cache.get_or_load(
+            ('songs', user_id), load,
+            lambda rows: [('user', user_id)] + [('track', row[6]) for row in rows]
         )
         
-        songs = cursor.fetchall()
-        conn.close()
-        return songs
-        
     except Exception as e:
         logger.error(f"❌ Ошибка получения песен: {e}")
         return []
 
-def get_song_videos(song_id, user_id, limit=10):
-    """Получение видео для песни"""
+def get_user_song(song_id, user_id):
+    """Одна песня пользователя по id подписки (чужую не вернет); поля как у get_user_songs"""
+    def load():
+        with db.reader() as conn:
+            return conn.execute(
+                '''SELECT s.id, s.name, s.song_url, t.song_id, s.created_at, t.last_checked, t.id, t.video_count
+                   FROM subscriptions s
+                   JOIN tracked_songs t ON s.tracked_song_id = t.id
+                   WHERE s.id = ? AND s.user_id = ?''',
+                (song_id, user_id)
+            ).fetchone()
+    
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''SELECT v.video_url, v.description, v.author_username, v.created_at 
-               FROM videos v 
-               JOIN songs s ON v.song_id = s.id 
-               WHERE s.id = ? AND s.user_id = ? 
-               ORDER BY v.created_at DESC 
-               LIMIT ?''',
-            (song_id, user_id, limit)
+        return read_cache.get_or_load(
+            ('song', song_id, user_id), load,
+            lambda row: [('user', user_id)] + ([('track', row[6])] if row else [])
         )
         
-        videos = cursor.fetchall()
-        conn.close()
-        return videos
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения песни: {e}")
+        return None
+
+def get_song_videos(song_id, user_id, limit=10, before=None, after=None):
+    """Страница видео песни (новые сверху) по ключу (created_at, id) без OFFSET.
+
+    before — видео старше курсора (следующая страница), after — новее
+    (предыдущая). Строки всегда возвращаются от новых к старым.
+    """
+    condition, order, params = '', 'DESC', [song_id, user_id]
+    if before:
+        condition, params = 'AND (v.created_at, v.id) < (?, ?)', params + list(before)
+    elif after:
+        condition, order, params = 'AND (v.created_at, v.id) > (?, ?)', 'ASC', params + list(after)
+    
+    def load():
+        with db.reader() as conn:
+            rows = conn.execute(
+                f'''SELECT v.video_url, v.description, v.author_username, v.created_at, v.id
+                   FROM subscriptions s
+                   JOIN videos v ON v.song_id = s.tracked_song_id
+                   WHERE s.id = ? AND s.user_id = ? {condition}
+                   ORDER BY v.created_at {order}, v.id {order}
+                   LIMIT ?''',
+                params + [limit]
+            ).fetchall()
+            return rows if order == 'DESC' else rows[::-1]
+    
+    try:
+        if before or after:
+            return load()
+        
+        # Первая страница кэшируется и сбрасывается при появлении новых видео звука
+        song = get_user_song(song_id, user_id)
+        if not song:
+            return []
+        return read_cache.get_or_load(('videos', song_id, user_id, limit), load, [('user', user_id), ('track', song[6])])
         
     except Exception as e:
         logger.error(f"❌ Ошибка получения видео: {e}")
         return []
 
 def get_song_videos_count(song_id, user_id):
-    """Получение количества видео для песни"""
+    """Получение количества видео для песни (из кэшируемой строки песни)"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''SELECT COUNT(*) 
-               FROM videos v 
-               JOIN songs s ON v.song_id = s.id 
-               WHERE s.id = ? AND s.user_id = ?''',
-            (song_id, user_id)
-        )
-        
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        song = get_user_song(song_id, user_id)
+        return song[7] if song else 0
         
     except Exception as e:
         logger.error(f"❌ Ошибка получения количества видео: {e}")
         return 0
 
 def delete_song(song_id, user_id):
-    """Удаление песни"""
+    """Удаление подписки (звук и его видео удаляются вместе с последним подписчиком)"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM videos WHERE song_id = ?', (song_id,))
-        cursor.execute('DELETE FROM songs WHERE id = ? AND user_id = ?', (song_id, user_id))
-        
-        conn.commit()
-        conn.close()
-        
+        with db.writer() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT tracked_song_id FROM subscriptions WHERE id = ? AND user_id = ?',
+                (song_id, user_id)
+            )
+            result = cursor.fetchone()
+            
+            if result:
+                tracked_song_id = result[0]
+                cursor.execute('DELETE FROM subscriptions WHERE id = ? AND user_id = ?', (song_id, user_id))
+                cursor.execute('DELETE FROM notifications_outbox WHERE subscription_id = ?', (song_id,))
+                
+                cursor.execute('SELECT 1 FROM subscriptions WHERE tracked_song_id = ? LIMIT 1', (tracked_song_id,))
+                if cursor.fetchone() is None:
+                    cursor.execute('DELETE FROM videos WHERE song_id = ?', (tracked_song_id,))
+                    cursor.execute('DELETE FROM tracked_songs WHERE id = ?', (tracked_song_id,))
+                    seen_videos.discard_song(tracked_song_id)
+        
+        # Сбрасываем после фиксации, чтобы параллельное чтение не закэшировало старое
+        if result:
+            read_cache.invalidate(('user', user_id), ('track', tracked_song_id))
         return True
         
     except Exception as e:
         logger.error(f"❌ Ошибка удаления песни: {e}")
         return False
 
-def add_video(song_id, video_data):
-    """Добавление видео в базу"""
+def add_videos(song_id, videos, exclude_user_id=None):
+    """Пакетное добавление видео одной транзакцией; возвращает только действительно новые.
+
+    В той же транзакции для каждого нового видео ставятся уведомления всем
+    подписчикам звука, кроме exclude_user_id (тот, кто запустил проверку вручную).
+    """
+    new_videos = []
+    
+    # Уже известные видео отсекаем в памяти, не трогая БД
+    candidates = [video for video in videos if not seen_videos.contains(song_id, video['url'])]
+    if not candidates:
+        return new_videos
+    
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        with db.writer() as conn:
+            cursor = conn.cursor()
+            seen_urls = set()
+            
+            for video_data in candidates:
+                if video_data['url'] in seen_urls:
+                    continue
+                seen_urls.add(video_data['url'])
+                
+                cursor.execute(
+                    '''INSERT OR IGNORE INTO videos 
+                       (song_id, video_url, description, author_username, author_name, tiktok_created_at) 
+                       VALUES (?, ?, ?, ?, ?, ?)''',
+                    (song_id, video_data['url'], video_data['description'], 
+                     video_data.get('author_username', ''), video_data.get('author_name', ''),
+                     video_id_time(video_data.get('video_id')) or video_data.get('created_at', datetime.now()))
+                )
+                if cursor.rowcount > 0:
+                    new_videos.append(video_data)
+                    cursor.execute(
+                        '''INSERT OR IGNORE INTO notifications_outbox (user_id, subscription_id, video_id)
+                           SELECT user_id, id, ? FROM subscriptions
+                           WHERE tracked_song_id = ? AND user_id != ?''',
+                        (cursor.lastrowid, song_id, exclude_user_id if exclude_user_id is not None else -1)
+                    )
+        
+        # Проигнорированные при вставке тоже уже есть в БД
+        seen_videos.add(song_id, seen_urls)
+        if new_videos:
+            read_cache.invalidate(('track', song_id))
+        
+        return new_videos
         
-        cursor.execute(
-            '''INSERT OR IGNORE INTO videos 
-               (song_id, video_url, description, author_username, author_name, tiktok_created_at) 
-               VALUES (?, ?, ?, ?, ?, ?)''',
-            (song_id, video_data['url'], video_data['description'], 
-             video_data.get('author_username', ''), video_data.get('author_name', ''),
-             video_data.get('created_at', datetime.now()))
-        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка добавления видео: {e}")
+        return []
+
+def update_song_last_checked(song_id, poll_interval=None, high_water_mark=None):
+    """Обновление времени последней проверки (интервала опроса и отметки новейшего видео, если переданы)"""
+    try:
+        with db.writer() as conn:
+            conn.execute(
+                '''UPDATE tracked_songs SET last_checked = CURRENT_TIMESTAMP,
+                       poll_interval = COALESCE(?, poll_interval),
+                       high_water_mark = COALESCE(?, high_water_mark)
+                   WHERE id = ?''',
+                (poll_interval, high_water_mark, song_id)
+            )
         
-        conn.commit()
-        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления времени проверки: {e}")
+
+def get_all_songs_for_checking():
+    """Получение всех отслеживаемых звуков, у которых есть подписчики"""
+    try:
+        with db.reader() as conn:
+            return conn.execute(
+                '''SELECT t.id, t.name, t.song_url, t.song_id, t.last_checked, t.poll_interval, t.high_water_mark
+                   FROM tracked_songs t
+                   WHERE EXISTS (SELECT 1 FROM subscriptions s WHERE s.tracked_song_id = t.id)'''
+            ).fetchall()
         
-        return cursor.rowcount > 0
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения песен для проверки: {e}")
+        return []
+
+def get_recent_video_counts(window_seconds):
+    """Число видео, опубликованных в TikTok за последние window_seconds, по каждому звуку.
+
+    Считаем по времени публикации, а не по времени записи в БД: иначе
+    первичная загрузка при добавлении звука выглядела бы как всплеск активности.
+    """
+    try:
+        with db.reader() as conn:
+            rows = conn.execute(
+                '''SELECT song_id, COUNT(*) FROM videos
+                   WHERE tiktok_created_at >= ?
+                   GROUP BY song_id''',
+                (datetime.now() - timedelta(seconds=window_seconds),)
+            ).fetchall()
+        return dict(rows)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка добавления видео: {e}")
-        return False
+        logger.error(f"❌ Ошибка подсчета активности песен: {e}")
+        return {}
 
-def get_video_exists(video_url):
-    """Проверка существования видео"""
+def get_song_subscribers():
+    """Подписчики всех звуков: {tracked_song_id: [(user_id, subscription_id, name), ...]}"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        with db.reader() as conn:
+            rows = conn.execute('SELECT tracked_song_id, user_id, id, name FROM subscriptions').fetchall()
         
-        cursor.execute('SELECT id FROM videos WHERE video_url = ?', (video_url,))
-        exists = cursor.fetchone() is not None
-        conn.close()
+        subscribers = {}
+        for tracked_song_id, user_id, subscription_id, name in rows:
+            subscribers.setdefault(tracked_song_id, []).append((user_id, subscription_id, name))
         
-        return exists
+        return subscribers
         
     except Exception as e:
-        logger.error(f"❌ Ошибка проверки видео: {e}")
-        return False
+        logger.error(f"❌ Ошибка получения подписчиков: {e}")
+        return {}
+
+def get_pending_notifications(limit, window_seconds=0):
+    """Уведомления, готовые к отправке, вместе с данными видео и подписки.
 
-def update_song_last_checked(song_id):
-    """Обновление времени последней проверки"""
+    Пользователь попадает в выборку, когда его самое старое ожидающее
+    уведомление старше window_seconds: звуки проверяются в разное время,
+    и окно собирает их новые видео в одну сводку.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        with db.reader() as conn:
+            return conn.execute(
+                '''SELECT o.id, o.user_id, o.subscription_id, s.name, o.attempts,
+                          v.video_url, v.description, v.author_username
+                   FROM notifications_outbox o
+                   JOIN videos v ON v.id = o.video_id
+                   JOIN subscriptions s ON s.id = o.subscription_id
+                   WHERE o.status = 'pending' AND o.next_attempt_at <= CURRENT_TIMESTAMP
+                     AND o.user_id IN (
+                         SELECT user_id FROM notifications_outbox
+                         WHERE status = 'pending'
+                         GROUP BY user_id
+                         HAVING MIN(created_at) <= datetime('now', ?)
+                     )
+                   ORDER BY o.id
+                   LIMIT ?''',
+                (f'-{int(window_seconds)} seconds', limit)
+            ).fetchall()
         
-        cursor.execute(
-            'UPDATE songs SET last_checked = CURRENT_TIMESTAMP WHERE id = ?',
-            (song_id,)
-        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения очереди уведомлений: {e}")
+        return []
+
+def mark_notifications_delivered(notification_ids):
+    """Пометка пачки уведомлений как доставленных"""
+    try:
+        with db.writer() as conn:
+            conn.executemany(
+                "UPDATE notifications_outbox SET status = 'sent', delivered_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [(notification_id,) for notification_id in notification_ids]
+            )
         
-        conn.commit()
-        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка отметки доставки уведомлений: {e}")
+
+def mark_notifications_failed(notification_ids, error, retry_in=None):
+    """Неудачная отправка: повтор через retry_in секунд или окончательный отказ"""
+    try:
+        with db.writer() as conn:
+            conn.executemany(
+                '''UPDATE notifications_outbox
+                   SET attempts = attempts + 1,
+                       last_error = ?,
+                       status = CASE WHEN ? IS NULL OR attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                       next_attempt_at = datetime('now', ?)
+                   WHERE id = ?''',
+                [(str(error)[:500], retry_in, OUTBOX_MAX_ATTEMPTS, f'+{int(retry_in or 0)} seconds', notification_id)
+                 for notification_id in notification_ids]
+            )
         
     except Exception as e:
-        logger.error(f"❌ Ошибка обновления времени проверки: {e}")
+        logger.error(f"❌ Ошибка отметки неудачных уведомлений: {e}")
 
-def get_all_songs_for_checking():
-    """Получение всех песен для периодической проверки"""
+def purge_delivered_notifications(days):
+    """Удаление старых обработанных уведомлений"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        with db.writer() as conn:
+            conn.execute(
+                "DELETE FROM notifications_outbox WHERE status != 'pending' AND created_at < datetime('now', ?)",
+                (f'-{int(days)} days',)
+            )
         
-        cursor.execute(
-            'SELECT id, user_id, name, song_url, song_id FROM songs'
-        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка очистки очереди уведомлений: {e}")
+
+def get_resolved_link(link, ttl_seconds):
+    """Разрешенная ранее ссылка: (song_name, song_id, canonical_url) или None, если нет или устарела"""
+    try:
+        with db.reader() as conn:
+            return conn.execute(
+                '''SELECT song_name, song_id, canonical_url FROM resolved_links
+                   WHERE link = ? AND resolved_at >= datetime('now', ?)''',
+                (link, f'-{int(ttl_seconds)} seconds')
+            ).fetchone()
         
-        songs = cursor.fetchall()
-        conn.close()
-        return songs
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения кэша ссылок: {e}")
+        return None
+
+def save_resolved_link(link, canonical_url, song_id, song_name):
+    """Сохранение результата разрешения ссылки"""
+    try:
+        with db.writer() as conn:
+            conn.execute(
+                '''INSERT OR REPLACE INTO resolved_links (link, canonical_url, song_id, song_name, resolved_at)
+                   VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)''',
+                (link, canonical_url, song_id, song_name)
+            )
         
     except Exception as e:
-        logger.error(f"❌ Ошибка получения песен для проверки: {e}")
-        return []
+        logger.error(f"❌ Ошибка сохранения кэша ссылок: {e}")
 
 # ========== РАБОЧИЙ ПАРСИНГ TIKTOK ==========
 
@@ -304,6 +965,35 @@ def extract_song_info_from_url(song_url):
         logger.error(f"❌ Ошибка извлечения информации из URL: {e}")
         return None, None
 
+TIKTOK_LINK_RE = re.compile(r'https?://\S*tiktok\.com\S*')
+
+def normalize_link(link):
+    """Ключ кэша ссылок: без схемы, параметров, якоря и завершающего слэша"""
+    parts = urlsplit(link.strip())
+    return f"{parts.netloc.lower()}{parts.path.rstrip('/')}"
+
+def music_url(song_name, song_id):
+    """Канонический URL звука, понятный extract_song_info_from_url"""
+    slug = re.sub(r'[\W_]+', '-', song_name or '').strip('-') or 'original-sound'
+    return f"https://www.tiktok.com/music/{slug}-{song_id}"
+
+def extract_music_from_video_page(html_content):
+    """Звук, прикрепленный к видео: (song_name, song_id) из данных гидратации страницы"""
+    try:
+        script_id, raw_json = slice_hydration_json(html_content)
+        if raw_json is None:
+            return None, None
+        
+        for item in iter_hydration_items(script_id, decode_json(raw_json)):
+            music = item.get('music') if isinstance(item, dict) else None
+            if isinstance(music, dict) and str(music.get('id') or '').isdigit():
+                return music.get('title') or f"Песня {music['id']}", str(music['id'])
+        
+    except Exception as e:
+        logger.debug(f"⚠️ Не удалось найти звук на странице видео: {e}")
+    
+    return None, None
+
 def get_rotating_headers():
     """Вращающиеся заголовки для обхода блокировок"""
     user_agents = [
@@ -319,45 +1009,506 @@ def get_rotating_headers():
         'User-Agent': random.choice(user_agents),
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
         'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-        'Accept-Encoding': 'gzip, deflate, br',
+        'Accept-Encoding': 'gzip, deflate',
         'DNT': '1',
-        'Connection': 'keep-alive',
         'Upgrade-Insecure-Requests': '1',
         'Sec-Fetch-Dest': 'document',
         'Sec-Fetch-Mode': 'navigate',
         'Sec-Fetch-Site': 'none',
     }
 
-async def make_safe_request(url, max_retries=3):
-    """Безопасный запрос с обходом защиты"""
-    for attempt in range(max_retries):
-        try:
-            headers = get_rotating_headers()
+# ========== HTTP-КЛИЕНТ ==========
+
+_http_session = None
+
+class HttpResponse:
+    """Ответ HTTP с уже прочитанным телом (соединение сразу возвращается в пул)"""
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+def get_http_session():
+    """Общая долгоживущая сессия aiohttp с пулом keep-alive соединений"""
+    global _http_session
+
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=30
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.info(f"🌐 HTTP-клиент создан (пул {HTTP_POOL_SIZE}, на хост {HTTP_POOL_PER_HOST})")
+
+    return _http_session
+
+async def close_http_session():
+    """Закрытие общей HTTP-сессии"""
+    global _http_session
+
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+async def http_get(url, headers=None, timeout=None):
+    """GET-запрос через общий пул соединений"""
+    session = get_http_session()
+    # Без явного timeout действуют таймауты сессии (timeout=None отключил бы их)
+    kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout, connect=HTTP_CONNECT_TIMEOUT)} if timeout else {}
+
+    async with session.get(url, headers=headers, **kwargs) as response:
+        content = await response.read()
+        return HttpResponse(str(response.url), response.status, response.headers, content, response.charset)
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ==========
+
+class CircuitOpenError(Exception):
+    """Хост временно отключен автоматом после серии 403/429"""
+
+def parse_retry_after(value):
+    """Заголовок Retry-After (секунды или HTTP-дата) в секундах ожидания"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Ведро токенов: не чаще rate запросов в секунду с запасом burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def block(self, seconds):
+        """Запрет запросов на seconds секунд (Retry-After)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        async with self._lock:
+            now = time.monotonic()
+            self._refill(now)
             
-            # Случайная задержка
-            delay = random.uniform(2, 5)
-            await asyncio.sleep(delay)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                self._refill(time.monotonic())
             
-            # Используем Session для куки
-            session = requests.Session()
-            response = session.get(url, headers=headers, timeout=15)
+            self.tokens -= 1
+
+class HostRateLimiter(TokenBucket):
+    """Token bucket и circuit breaker для одного хоста.
+
+    Ведро пополняется со скоростью rate токенов в секунду до burst; Retry-After
+    блокирует хост на указанное время. Если за BREAKER_WINDOW секунд пришло
+    BREAKER_FAILURE_THRESHOLD ответов 403/429, автомат размыкается на
+    BREAKER_COOLDOWN секунд, после чего пропускает один пробный запрос.
+    """
+
+    def __init__(self, host, rate=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST):
+        super().__init__(rate, burst)
+        self.host = host
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.failures = deque()
+
+    def _check_breaker(self, now):
+        if self.state == 'open':
+            if now - self.opened_at < BREAKER_COOLDOWN:
+                raise CircuitOpenError(self.host)
+            self.state = 'half_open'
+            logger.info(f"🔌 {self.host}: пробный запрос после паузы")
+        if self.state == 'half_open':
+            if self.probe_in_flight:
+                raise CircuitOpenError(self.host)
+            self.probe_in_flight = True
+
+    async def acquire(self):
+        """Ожидание разрешения на запрос"""
+        self._check_breaker(time.monotonic())
+        try:
+            await super().acquire()
+        except BaseException:
+            self.probe_in_flight = False
+            raise
+
+    def release(self):
+        """Запрос отменен без ответа: освобождаем пробу, не считая это отказом"""
+        self.probe_in_flight = False
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.failures.clear()
+        logger.warning(f"🔌 {self.host}: автомат разомкнут на {BREAKER_COOLDOWN} с")
+
+    def record(self, status_code=None, retry_after=None):
+        """Учет результата запроса; status_code=None — сетевая ошибка"""
+        now = time.monotonic()
+        was_probe = self.probe_in_flight
+        self.probe_in_flight = False
+        
+        delay = parse_retry_after(retry_after)
+        if status_code == 429 and delay is None:
+            delay = RATE_LIMIT_DEFAULT_BACKOFF
+        if delay:
+            self.block(delay)
+        
+        if status_code in (403, 429):
+            if was_probe:
+                self._open(now)
+                return
+            self.failures.append(now)
+            while self.failures and now - self.failures[0] > BREAKER_WINDOW:
+                self.failures.popleft()
+            if len(self.failures) >= BREAKER_FAILURE_THRESHOLD:
+                self._open(now)
+        elif status_code is not None and status_code < 500:
+            if self.state == 'half_open':
+                logger.info(f"🔌 {self.host}: автомат снова замкнут")
+            self.state = 'closed'
+            self.failures.clear()
+        elif was_probe:
+            self._open(now)
+
+_host_limiters = {}
+
+def get_host_limiter(url):
+    """Ограничитель для хоста из URL (создается лениво внутри event loop)"""
+    host = urlsplit(url).hostname or ''
+    if host not in _host_limiters:
+        _host_limiters[host] = HostRateLimiter(host)
+    return _host_limiters[host]
+
+async def limited_get(url, headers=None, timeout=None):
+    """GET с учетом ограничения частоты и автомата хоста"""
+    limiter = get_host_limiter(url)
+    await limiter.acquire()
+    
+    try:
+        response = await http_get(url, headers=headers, timeout=timeout)
+    except asyncio.CancelledError:
+        # Отмена (например, проигравший в гонке источник) — не ошибка хоста
+        limiter.release()
+        raise
+    except BaseException:
+        limiter.record(None)
+        raise
+    
+    limiter.record(response.status_code, response.headers.get('Retry-After'))
+    return response
+
+async def make_safe_request(url, max_retries=3, headers=None, outcome=None):
+    """Безопасный запрос с обходом защиты; причина неудачи — в outcome['reason']"""
+    outcome = outcome if outcome is not None else {}
+    for attempt in range(max_retries):
+        try:
+            request_headers = get_rotating_headers()
+            if headers:
+                request_headers.update(headers)
+            response = await limited_get(url, headers=request_headers)
             
-            if response.status_code == 200:
+            # 304 приходит только на условный запрос из fetch_cached
+            if response.status_code in (200, 304):
                 return response
-            elif response.status_code == 403:
+            
+            outcome['reason'] = f"HTTP {response.status_code}"
+            if response.status_code == 403:
                 logger.warning(f"⚠️ 403 Forbidden. Попытка {attempt + 1}. Меняем подход...")
-                # Пробуем с другими параметрами
-                continue
             elif response.status_code == 429:
-                logger.warning("⚠️ Rate limited. Ждем 10 секунд...")
-                await asyncio.sleep(10)
+                logger.warning(f"⚠️ Rate limited. Попытка {attempt + 1}")
+            elif response.status_code < 500:
+                # Остальные 4xx повтор не исправит
+                return None
                 
+        except CircuitOpenError:
+            logger.info(f"🔌 Хост отключен автоматом, пропускаем: {url}")
+            outcome['reason'] = 'хост отключен автоматом'
+            outcome['circuit_open'] = True
+            return None
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.warning(f"⚠️ Ошибка запроса (попытка {attempt + 1}): {e}")
-            await asyncio.sleep(3)
+            outcome['reason'] = str(e) or type(e).__name__
     
     return None
 
+class ResponseCache:
+    """Валидаторы (ETag/Last-Modified), хэш тела и результат разбора по URL.
+
+    Если сервер ответил 304 или тело совпало по хэшу с прошлым, повторно
+    отдается сохраненный результат разбора — страница не разбирается заново.
+    Размер ограничен max_entries, вытесняются давно не запрошенные URL (LRU).
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    def get(self, url):
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+
+    def conditional_headers(self, url):
+        """Заголовки условного запроса для ранее полученного URL"""
+        entry = self.get(url)
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response, content_hash, parsed):
+        self._entries[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_hash': content_hash,
+            'parsed': parsed,
+        }
+        self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.not_modified + self.misses
+        reused = self.hits + self.not_modified
+        ratio = reused / total * 100 if total else 0.0
+        return (f"URL {len(self._entries)}/{self.max_entries}, 304: {self.not_modified}, "
+                f"тот же хэш: {self.hits}, разобрано: {self.misses} ({ratio:.0f}% без разбора)")
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+async def fetch_cached(url, parse, outcome=None):
+    """Условный запрос; parse(content, encoding) вызывается только для изменившегося тела.
+
+    Возвращает результат разбора (свежий или сохраненный) либо None, если
+    запрос не удался. Исключения parse (например, ValueError) не перехватываются.
+    """
+    response = await make_safe_request(url, headers=response_cache.conditional_headers(url), outcome=outcome)
+    if response is None:
+        return None
+    
+    entry = response_cache.get(url)
+    if response.status_code == 304:
+        if entry is None:
+            return None
+        response_cache.not_modified += 1
+        return entry['parsed']
+    
+    content_hash = hashlib.blake2b(response.content, digest_size=16).digest()
+    if entry is not None and entry['content_hash'] == content_hash:
+        response_cache.hits += 1
+        # Обновляем валидаторы, разбор оставляем прежним
+        response_cache.store(url, response, content_hash, entry['parsed'])
+        return entry['parsed']
+    
+    response_cache.misses += 1
+    parsed = await run_parser(parse, response.content, response.encoding)
+    response_cache.store(url, response, content_hash, parsed)
+    return parsed
+
+# ========== ПУЛ РАЗБОРА ==========
+
+_parse_executor = None
+
+def get_parse_executor():
+    """Пул для разбора страниц; создается при первом крупном ответе"""
+    global _parse_executor
+
+    if _parse_executor is None:
+        if PARSE_POOL == 'thread':
+            _parse_executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix='parser')
+        else:
+            # spawn: дочерние процессы не наследуют потоки и соединения бота
+            _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        logger.info(f"🧮 Пул разбора запущен ({PARSE_POOL}, воркеров: {PARSE_WORKERS})")
+
+    return _parse_executor
+
+def shutdown_parse_executor():
+    """Остановка пула разбора"""
+    global _parse_executor
+
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+    _parse_executor = None
+
+async def run_parser(parse, content, encoding):
+    """Разбор тела ответа вне event loop; маленькие ответы — на месте без пересылки"""
+    if PARSE_WORKERS <= 0 or len(content) <= PARSE_INLINE_MAX_BYTES:
+        return parse(content, encoding)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_parse_executor(), parse, content, encoding)
+
+class EndpointHealth:
+    """Скользящая статистика одного эндпоинта: успехи, задержки, выход видео"""
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)  # (успех, задержка, число видео)
+        self.consecutive_failures = 0
+        self.last_failure = None
+        self.probe_at = 0.0
+
+    def record(self, ok, latency, videos, reason=None):
+        self.samples.append((ok, latency, videos))
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+            self.last_failure = reason
+
+    @property
+    def success_rate(self):
+        if not self.samples:
+            return 1.0  # новый эндпоинт сначала пробуем
+        return sum(1 for ok, _, _ in self.samples if ok) / len(self.samples)
+
+    @property
+    def video_yield(self):
+        if not self.samples:
+            return 0.0
+        return sum(videos for _, _, videos in self.samples) / len(self.samples)
+
+    def latency_percentile(self, percent):
+        latencies = sorted(latency for _, latency, _ in self.samples)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    @property
+    def dead(self):
+        return self.consecutive_failures >= ENDPOINT_DEAD_AFTER
+
+    def score(self):
+        """Чем больше, тем раньше пробуем: ожидаемые видео на запрос с поправкой на задержку"""
+        return self.success_rate * (1 + self.video_yield) / (1 + self.latency_percentile(50))
+
+class EndpointScoreboard:
+    """Порядок опроса эндпоинтов по их здоровью.
+
+    Эндпоинт, не ответивший ENDPOINT_DEAD_AFTER раз подряд (ошибка, 403,
+    не JSON), пропускается и раз в ENDPOINT_PROBE_INTERVAL пробуется снова
+    одним запросом; первый успех возвращает его в работу. Слот пробы
+    занимает fetch_endpoint при реальном запросе, а не order()/available().
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._endpoints = {}
+
+    def get(self, name):
+        if name not in self._endpoints:
+            self._endpoints[name] = EndpointHealth(self.window)
+        return self._endpoints[name]
+
+    def available(self, name, now=None):
+        """Можно ли обращаться к эндпоинту (без побочных эффектов)"""
+        health = self.get(name)
+        return not health.dead or (now or time.time()) >= health.probe_at
+
+    def claim_probe(self, name, now=None):
+        """Перед запросом: у отключенного эндпоинта занимает слот пробы; False — проба уже идет или рано"""
+        health = self.get(name)
+        if not health.dead:
+            return True
+        now = now or time.time()
+        if now < health.probe_at:
+            return False
+        health.probe_at = now + ENDPOINT_PROBE_INTERVAL
+        logger.info(f"🩺 Повторная проба эндпоинта {name} (последняя ошибка: {health.last_failure})")
+        return True
+
+    def release_probe(self, name):
+        """Запрос пробы не был отправлен — слот снова свободен"""
+        self.get(name).probe_at = 0.0
+
+    def order(self, endpoints):
+        """[(имя, url), ...] по убыванию оценки, без отключенных эндпоинтов"""
+        alive = [(name, url) for name, url in endpoints if self.available(name)]
+        return sorted(alive, key=lambda endpoint: self.get(endpoint[0]).score(), reverse=True)
+
+    def record(self, name, ok, latency, videos, reason=None):
+        self.get(name).record(ok, latency, videos, reason)
+
+    def stats(self):
+        parts = []
+        for name, health in sorted(self._endpoints.items()):
+            state = 'отключен' if health.dead else f"{health.success_rate * 100:.0f}%"
+            parts.append(
+                f"{name}: {state}, p50 {health.latency_percentile(50):.1f} с, "
+                f"p95 {health.latency_percentile(95):.1f} с, {health.video_yield:.1f} видео/запрос"
+                + (f", ошибка: {health.last_failure}" if health.last_failure else '')
+            )
+        return '; '.join(parts) or 'нет данных'
+
+endpoint_scoreboard = EndpointScoreboard(ENDPOINT_STATS_WINDOW)
+
+async def fetch_endpoint(endpoint, url, parse, count=len):
+    """fetch_cached с записью результата в статистику эндпоинта"""
+    if not endpoint_scoreboard.claim_probe(endpoint):
+        return None
+    
+    outcome = {}
+    started = time.monotonic()
+    try:
+        parsed = await fetch_cached(url, parse, outcome)
+    except ValueError:
+        endpoint_scoreboard.record(endpoint, False, time.monotonic() - started, 0, 'ответ не JSON')
+        raise
+    
+    latency = time.monotonic() - started
+    if outcome.get('circuit_open'):
+        # Хост целиком на паузе у автомата — о самом эндпоинте это ничего не говорит,
+        # а проба отключенного эндпоинта не состоялась
+        if endpoint_scoreboard.get(endpoint).dead:
+            endpoint_scoreboard.release_probe(endpoint)
+        return parsed
+    if parsed is None:
+        endpoint_scoreboard.record(endpoint, False, latency, 0, outcome.get('reason', 'нет ответа'))
+    else:
+        endpoint_scoreboard.record(endpoint, True, latency, count(parsed))
+    return parsed
+
 async def parse_via_rapidapi(song_id):
     """Парсинг через RapidAPI (если есть ключ)"""
     videos = []
@@ -373,7 +1524,7 @@ async def parse_via_rapidapi(song_id):
             'X-RapidAPI-Host': 'tiktok-scraper7.p.rapidapi.com'
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = await limited_get(url, headers=headers, timeout=10)
         if response.status_code == 200:
             data = response.json()
             # Обработка данных...
@@ -386,232 +1537,246 @@ async def parse_via_rapidapi(song_id):
 async def parse_via_web_scraping(song_url, song_id, song_name):
     """Веб-скрапинг страницы поиска"""
     videos = []
+    seen_urls = set()
     
     try:
         # Страница поиска по названию песни
         search_query = song_name.replace(' ', '%20')
-        search_urls = [
-            f"https://www.tiktok.com/search?q={search_query}",
-            f"https://www.tiktok.com/tag/{search_query}",
-            f"https://www.tiktok.com/search/video?q={search_query}"
-        ]
+        search_urls = endpoint_scoreboard.order([
+            ('search', f"https://www.tiktok.com/search?q={search_query}"),
+            ('tag', f"https://www.tiktok.com/tag/{search_query}"),
+            ('search_video', f"https://www.tiktok.com/search/video?q={search_query}"),
+        ])
         
-        for search_url in search_urls:
+        for endpoint, search_url in search_urls:
             if len(videos) >= 20:  # Ограничиваем
                 break
                 
             logger.info(f"🔍 Парсим поисковую страницу: {search_url}")
-            response = await make_safe_request(search_url)
+            page_videos = await fetch_endpoint(endpoint, search_url, parse_html_payload)
             
-            if response and response.status_code == 200:
-                page_videos = extract_videos_from_html(response.text)
+            if page_videos is not None:
                 for video in page_videos:
-                    if not any(v['url'] == video['url'] for v in videos):
+                    if video['url'] not in seen_urls:
+                        seen_urls.add(video['url'])
                         videos.append(video)
                 
                 logger.info(f"✅ Найдено видео на странице: {len(page_videos)}")
-            
-            await asyncio.sleep(3)  # Пауза
         
     except Exception as e:
         logger.error(f"❌ Ошибка веб-скрапинга: {e}")
     
     return videos
 
-def extract_videos_from_html(html_content):
-    """Извлечение видео из HTML страницы"""
+def video_id_number(video_id):
+    """Числовой ID видео TikTok (растет со временем публикации) или None"""
+    video_id = str(video_id or '')
+    # Настоящие ID укладываются в 19 цифр; длиннее — синтетические заглушки
+    if video_id.isdigit() and len(video_id) <= 19:
+        return int(video_id)
+    return None
+
+def video_id_time(video_id):
+    """Время публикации из ID видео (старшие 32 бита — unix-время) или None"""
+    number = video_id_number(video_id)
+    if number is None:
+        return None
+    created = number >> 32
+    # Отсекаем ID, которые не похожи на настоящие (до 2016 года или из будущего)
+    if not 1451606400 <= created <= time.time() + 86400:
+        return None
+    return datetime.fromtimestamp(created)
+
+def newest_video_mark(videos, high_water_mark=None):
+    """Новая отметка новейшего видео звука с учетом прежней"""
+    numbers = [video_id_number(video.get('video_id')) for video in videos]
+    numbers.append(video_id_number(high_water_mark))
+    numbers = [number for number in numbers if number is not None]
+    return str(max(numbers)) if numbers else None
+
+async def crawl_music_item_list(song_id, high_water_mark=None, max_results=30, crawl_state=None):
+    """Постраничный обход видео звука до уже известной территории.
+
+    Предполагается, что страницы идут от новых видео к старым, но порядок
+    внутри страницы не важен (популярные видео бывают подняты выше свежих).
+    Поэтому обход останавливается на первой странице, где нет ни одного ID
+    новее отметки, а не на первом старом видео.
+
+    Новая отметка записывается в crawl_state['high_water_mark'] только если
+    обход сомкнулся с известными видео (или список кончился). При ошибке
+    страницы или исчерпании CRAWL_MAX_PAGES отметка остается прежней, и
+    следующая проверка снова пролистает непройденный промежуток.
+    """
     videos = []
+    known_mark = video_id_number(high_water_mark)
+    cursor = 0
+    complete = False
+    
+    if not endpoint_scoreboard.available('music_item_list'):
+        return videos
     
     try:
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Ищем ссылки на видео в различных форматах
-        video_patterns = [
-            r'https://www\.tiktok\.com/@[^/]+/video/\d+',
-            r'href="(/@[^/]+/video/\d+)"',
-            r'video/(\d+)'
-        ]
-        
-        # Поиск в тексте страницы
-        for pattern in video_patterns:
-            matches = re.findall(pattern, html_content)
-            for match in matches:
-                if isinstance(match, tuple):
-                    video_id = match[0]
-                else:
-                    video_id = match
-                
-                # Формируем URL
-                if isinstance(match, tuple) and match[0].startswith('/'):
-                    video_url = f"https://www.tiktok.com{match[0]}"
-                elif isinstance(match, str) and match.startswith('/'):
-                    video_url = f"https://www.tiktok.com{match}"
-                elif isinstance(match, str) and match.isdigit():
-                    video_url = f"https://www.tiktok.com/@user/video/{match}"
-                else:
-                    video_url = match
-                
-                video_data = {
-                    'url': video_url,
-                    'description': f'Видео с песней (ID: {video_id})',
-                    'author_username': 'unknown',
-                    'author_name': 'TikTok пользователь',
-                    'video_id': video_id,
-                    'created_at': datetime.now()
-                }
-                
-                if video_url not in [v['url'] for v in videos]:
-                    videos.append(video_data)
-        
-        # Также ищем через BeautifulSoup
-        for a_tag in soup.find_all('a', href=True):
-            href = a_tag.get('href', '')
-            if '/video/' in href:
-                if href.startswith('/'):
-                    video_url = f"https://www.tiktok.com{href}"
-                else:
-                    video_url = href
-                
-                if video_url not in [v['url'] for v in videos]:
-                    video_id = re.search(r'video/(\d+)', href)
-                    video_id = video_id.group(1) if video_id else 'unknown'
-                    
-                    videos.append({
-                        'url': video_url,
-                        'description': 'Видео с TikTok',
-                        'author_username': 'unknown',
-                        'author_name': 'TikTok пользователь',
-                        'video_id': video_id,
-                        'created_at': datetime.now()
-                    })
+        for page in range(CRAWL_MAX_PAGES):
+            api_url = f"https://www.tiktok.com/api/music/item_list/?musicID={song_id}&count={CRAWL_PAGE_SIZE}&cursor={cursor}"
+            logger.info(f"🔧 Список видео звука, страница {page + 1}: {api_url}")
+            try:
+                page_data = await fetch_endpoint('music_item_list', api_url, parse_item_list_payload, lambda page_data: len(page_data[0]))
+            except ValueError:
+                logger.debug("⚠️ Ответ не JSON")
+                break
+            if page_data is None:
+                break
+            
+            page_videos, has_more, next_cursor = page_data
+            videos.extend(page_videos)
+            if not page_videos or not has_more:
+                complete = True
+                break
+            
+            if known_mark is None:
+                # Первый обход: история до начала отслеживания не нужна
+                if len(videos) >= max_results:
+                    complete = True
+                    break
+            else:
+                # Вся страница уже известна — дальше листать незачем
+                page_numbers = [video_id_number(video['video_id']) for video in page_videos]
+                page_numbers = [number for number in page_numbers if number is not None]
+                if not page_numbers or max(page_numbers) <= known_mark:
+                    complete = True
+                    break
+            
+            cursor = next_cursor or cursor + len(page_videos)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка извлечения видео из HTML: {e}")
+        logger.error(f"❌ Ошибка обхода списка видео звука: {e}")
+    
+    if complete and crawl_state is not None:
+        crawl_state['high_water_mark'] = newest_video_mark(videos, high_water_mark)
     
     return videos
 
-async def parse_via_public_api(song_id):
+async def parse_via_public_api(song_id, high_water_mark=None, max_results=30, crawl_state=None):
     """Попытка использовать публичные API"""
     videos = []
     
     try:
+        # Постраничный список звука; в установившемся режиме — одна страница
+        videos = await crawl_music_item_list(song_id, high_water_mark, max_results, crawl_state)
+        if videos:
+            logger.info(f"✅ Список звука вернул видео: {len(videos)}")
+            return videos
+        
         # Публичные эндпоинты (могут меняться)
-        public_apis = [
-            f"https://www.tiktok.com/node/share/music/{song_id}",
-            f"https://m.tiktok.com/api/music/detail/?musicId={song_id}",
-        ]
+        public_apis = endpoint_scoreboard.order([
+            ('node_share_music', f"https://www.tiktok.com/node/share/music/{song_id}"),
+            ('m_music_detail', f"https://m.tiktok.com/api/music/detail/?musicId={song_id}"),
+        ])
         
-        for api_url in public_apis:
+        for endpoint, api_url in public_apis:
             logger.info(f"🔧 Пробуем публичный API: {api_url}")
-            response = await make_safe_request(api_url)
-            
-            if response and response.status_code == 200:
-                try:
-                    data = response.json()
-                    # Пробуем извлечь видео из разных структур JSON
-                    extracted = extract_from_json_structure(data)
+            try:
+                # Пробуем извлечь видео из разных структур JSON
+                extracted = await fetch_endpoint(endpoint, api_url, parse_json_videos_payload)
+                if extracted is not None:
                     videos.extend(extracted)
                     logger.info(f"✅ API вернул видео: {len(extracted)}")
-                except json.JSONDecodeError:
-                    logger.debug("⚠️ Ответ не JSON")
-            
-            await asyncio.sleep(2)
+            except ValueError:
+                logger.debug("⚠️ Ответ не JSON")
             
     except Exception as e:
         logger.error(f"❌ Ошибка публичного API: {e}")
     
     return videos
 
-def extract_from_json_structure(data):
-    """Извлечение видео из различных JSON структур"""
+_source_semaphores = {}
+
+def get_source_semaphore(source):
+    """Семафор, ограничивающий число одновременных запросов к источнику"""
+    # Создаем лениво, чтобы семафор привязался к работающему event loop
+    if source not in _source_semaphores:
+        _source_semaphores[source] = asyncio.Semaphore(SOURCE_CONCURRENCY.get(source, CHECK_CONCURRENCY))
+    return _source_semaphores[source]
+
+async def run_source(source, fetch, delay, start_now):
+    """Запуск источника: после задержки хеджирования или сразу по сигналу start_now"""
+    if delay > 0:
+        try:
+            await asyncio.wait_for(start_now.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+    async with get_source_semaphore(source):
+        return await fetch()
+
+async def race_sources(sources, enough):
+    """Параллельный опрос источников [(имя, fetch, задержка)] до первых enough видео.
+
+    Источники с задержкой стартуют раньше, если предыдущий завершился, не набрав
+    enough. Как только видео достаточно, оставшиеся источники отменяются.
+    """
     videos = []
+    seen_urls = set()
+    start_now = asyncio.Event()
+    tasks = {
+        asyncio.ensure_future(run_source(source, fetch, delay, start_now)): source
+        for source, fetch, delay in sources
+    }
+    pending = set(tasks)
     
-    def find_videos(obj, path=""):
-        if isinstance(obj, dict):
-            # Проверяем признаки видео
-            if any(key in obj for key in ['video', 'itemId', 'id', 'videoUrl', 'webVideoUrl']):
-                video_data = create_video_data(obj)
-                if video_data:
-                    videos.append(video_data)
-            
-            for key, value in obj.items():
-                find_videos(value, f"{path}.{key}")
+    try:
+        while pending and len(videos) < enough:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    source_videos = task.result()
+                except Exception as e:
+                    logger.warning(f"⚠️ Источник {tasks[task]} завершился ошибкой: {e}")
+                    continue
                 
-        elif isinstance(obj, list):
-            for item in obj:
-                find_videos(item, path)
+                added = 0
+                for video in source_videos:
+                    if video['url'] not in seen_urls:
+                        seen_urls.add(video['url'])
+                        videos.append(video)
+                        added += 1
+                logger.info(f"📥 {tasks[task]}: {len(source_videos)} видео, новых в выдаче {added}")
+            
+            # Быстрый источник не справился — не ждем задержки остальных
+            if len(videos) < enough:
+                start_now.set()
+        
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.info(f"✂️ Отменены медленные источники: {', '.join(sorted(tasks[task] for task in pending))}")
     
-    find_videos(data)
     return videos
 
-def create_video_data(item):
-    """Создание данных видео из элемента"""
+async def get_videos_for_song(song_url, song_id, song_name, max_results=30, high_water_mark=None, crawl_state=None):
+    """Основная функция: гонка источников с хеджированием и fallback"""
     try:
-        video_id = item.get('id') or item.get('itemId') or 'unknown'
-        
-        # URL видео
-        video_url = None
-        if 'video' in item and 'downloadAddr' in item['video']:
-            video_url = item['video']['downloadAddr']
-        elif 'videoUrl' in item:
-            video_url = item['videoUrl']
-        elif 'webVideoUrl' in item:
-            video_url = item['webVideoUrl']
-        else:
-            video_url = f"https://www.tiktok.com/@user/video/{video_id}"
-        
-        # Описание
-        description = item.get('desc') or item.get('description') or f'Видео {video_id}'
-        if len(description) > 200:
-            description = description[:200] + '...'
-        
-        # Автор
-        author = item.get('author', {})
-        author_username = author.get('uniqueId', 'unknown')
-        author_name = author.get('nickname', 'Неизвестный автор')
+        logger.info(f"🎵 Поиск видео для: {song_name} (ID: {song_id})")
         
-        return {
-            'url': video_url,
-            'description': description,
-            'author_username': author_username,
-            'author_name': author_name,
-            'video_id': video_id,
-            'created_at': datetime.now()
-        }
+        # Публичные API стартуют сразу, веб-скрапинг — с задержкой хеджирования
+        sources = [
+            ('public_api', lambda: parse_via_public_api(song_id, high_water_mark, max_results, crawl_state), 0),
+            ('web_scraping', lambda: parse_via_web_scraping(song_url, song_id, song_name), SOURCE_HEDGE_DELAY),
+        ]
+        all_videos = await race_sources(sources, min(max_results, SOURCE_ENOUGH_VIDEOS))
         
-    except Exception as e:
-        logger.debug(f"⚠️ Ошибка создания данных видео: {e}")
-        return None
-
-async def get_videos_for_song(song_url, song_id, song_name, max_results=30):
-    """Основная функция с fallback методами"""
-    all_videos = []
-    
-    try:
-        logger.info(f"🎵 Поиск видео для: {song_name} (ID: {song_id})")
+        # Платный RapidAPI — только если бесплатные источники почти ничего не дали
+        if len(all_videos) < 5 and os.getenv('RAPIDAPI_KEY'):
+            logger.info("Проверяем RapidAPI...")
+            async with get_source_semaphore('rapidapi'):
+                rapidapi_videos = await parse_via_rapidapi(song_id)
+            seen_urls = {video['url'] for video in all_videos}
+            all_videos.extend(video for video in rapidapi_videos if video['url'] not in seen_urls)
         
-        # Метод 1: Публичные API
-        logger.info("1. Пробуем публичные API...")
-        api_videos = await parse_via_public_api(song_id)
-        all_videos.extend(api_videos)
-        
-        # Метод 2: Веб-скрапинг поиска
-        if len(all_videos) < 10:
-            logger.info("2. Веб-скрапинг поисковых страниц...")
-            scraped_videos = await parse_via_web_scraping(song_url, song_id, song_name)
-            for video in scraped_videos:
-                if not any(v['url'] == video['url'] for v in all_videos):
-                    all_videos.append(video)
-        
-        # Метод 3: RapidAPI (если есть ключ)
-        if len(all_videos) < 5:
-            logger.info("3. Проверяем RapidAPI...")
-            rapidapi_videos = await parse_via_rapidapi(song_id)
-            all_videos.extend(rapidapi_videos)
-        
-        # Метод 4: Fallback - тестовые данные если ничего не найдено
+        # Fallback - тестовые данные, если ничего не найдено
         if len(all_videos) == 0:
-            logger.info("4. Fallback: тестовые данные...")
+            logger.info("Fallback: тестовые данные...")
             for i in range(5):
                 all_videos.append({
                     'url': f"https://www.tiktok.com/@{song_name}/video/7{song_id}{i}",
@@ -622,17 +1787,12 @@ async def get_videos_for_song(song_url, song_id, song_name, max_results=30):
                     'created_at': datetime.now()
                 })
         
-        # Убираем дубликаты
-        unique_videos = []
-        seen_urls = set()
-        for video in all_videos:
-            if video['url'] not in seen_urls:
-                seen_urls.add(video['url'])
-                unique_videos.append(video)
+        logger.info(f"🎉 Итог: найдено {len(all_videos)} видео")
         
-        logger.info(f"🎉 Итог: найдено {len(unique_videos)} видео")
-        
-        return unique_videos[:max_results]
+        # Инкрементальный обход уже ограничен известными видео — не обрезаем выдачу
+        if high_water_mark is not None:
+            return all_videos
+        return all_videos[:max_results]
         
     except Exception as e:
         logger.error(f"❌ Критическая ошибка поиска: {e}")
@@ -646,6 +1806,54 @@ async def get_videos_for_song(song_url, song_id, song_name, max_results=30):
             'created_at': datetime.now()
         }]
 
+# ========== РАЗРЕШЕНИЕ ССЫЛОК ==========
+
+async def resolve_song_link(song_url):
+    """Ссылка (музыка, короткая vm/t, видео) → (song_name, song_id, canonical_url).
+
+    Ссылки на /music/ разбираются без сети. Остальные разрешаются одним
+    запросом с переходом по редиректам, результат хранится в resolved_links
+    LINK_CACHE_TTL секунд, поэтому повторная вставка той же ссылки сеть не трогает.
+    """
+    song_name, song_id = extract_song_info_from_url(song_url)
+    if song_id:
+        return song_name, song_id, song_url
+    
+    link = normalize_link(song_url)
+    cached = await db.run(get_resolved_link, link, LINK_CACHE_TTL)
+    if cached:
+        logger.info(f"🔗 Ссылка из кэша: {song_url}")
+        return cached
+    
+    logger.info(f"🔗 Разрешаем ссылку: {song_url}")
+    response = await make_safe_request(song_url)
+    if response is None:
+        return None, None, None
+    
+    # Редирект мог привести сразу на страницу звука
+    song_name, song_id = extract_song_info_from_url(response.url)
+    if not song_id:
+        song_name, song_id = extract_music_from_video_page(response.text)
+    if not song_id:
+        return None, None, None
+    
+    canonical_url = music_url(song_name, song_id)
+    await db.run(save_resolved_link, link, canonical_url, song_id, song_name)
+    return song_name, song_id, canonical_url
+
+async def resolve_song_links(links):
+    """Параллельное разрешение пакета ссылок: {ссылка: (song_name, song_id, canonical_url)}"""
+    unique_links = list(dict.fromkeys(links))
+    results = await asyncio.gather(*(resolve_song_link(link) for link in unique_links), return_exceptions=True)
+    
+    resolved = {}
+    for link, result in zip(unique_links, results):
+        if isinstance(result, Exception):
+            logger.error(f"❌ Ошибка разрешения ссылки {link}: {result}")
+            result = (None, None, None)
+        resolved[link] = result
+    return resolved
+
 # Остальные функции (process_song_link, check_new_videos_for_user, etc.) остаются аналогичными
 # но используют get_videos_for_song вместо simulate_video_search
 
@@ -663,12 +1871,15 @@ async def process_song_link(user_id, song_url, progress_callback=None):
         if progress_callback:
             await progress_callback("🔍 Извлекаю информацию о песне...")
         
-        song_name, song_id = extract_song_info_from_url(song_url)
+        song_name, song_id, song_url = await resolve_song_link(song_url)
         if not song_name or not song_id:
             return False, "❌ Не удалось распознать песню. Проверьте ссылку."
         
         # Добавляем песню в базу
-        song_db_id, is_new = add_song(user_id, song_name, song_url, song_id)
+        song_db_id, tracked_song_id, is_new = await db.run(add_song, user_id, song_name, song_url, song_id)
+        
+        if not song_db_id:
+            return False, "❌ Не удалось сохранить песню. Попробуйте позже."
         
         if not is_new:
             return False, "❌ Эта песня уже добавлена."
@@ -683,18 +1894,14 @@ async def process_song_link(user_id, song_url, progress_callback=None):
             await progress_callback(f"📹 Найдено {len(videos)} видео. Сохраняю...")
         
         # Сохраняем видео
-        saved_count = 0
-        for i, video in enumerate(videos):
-            if add_video(song_db_id, video):
-                saved_count += 1
-            
-            if progress_callback and i % 5 == 0 and i > 0:
-                await progress_callback(f"📹 Сохранено {saved_count} из {len(videos)} видео...")
+        await db.run(add_videos, tracked_song_id, videos, exclude_user_id=user_id)
+        await db.run(update_song_last_checked, tracked_song_id)
         
-        update_song_last_checked(song_db_id)
+        # Звук мог уже отслеживаться другими пользователями — показываем все его видео
+        total_count = await db.run(get_song_videos_count, song_db_id, user_id)
         
-        if saved_count > 0:
-            return True, f"✅ **{song_name}** добавлена!\n\n🎵 **Найдено видео: {saved_count}**\n\n📊 Теперь я буду отслеживать новые видео с этой песней!\n\n💡 *Реальный парсинг TikTok*"
+        if total_count > 0:
+            return True, f"✅ **{song_name}** добавлена!\n\n🎵 **Найдено видео: {total_count}**\n\n📊 Теперь я буду отслеживать новые видео с этой песней!\n\n💡 *Реальный парсинг TikTok*"
         else:
             return True, f"✅ **{song_name}** добавлена!\n\n📭 Видео пока не найдено.\n\n🔄 Попробуйте проверить позже или использовать поиск."
         
@@ -707,28 +1914,29 @@ async def check_new_videos_for_user(user_id):
     new_videos = []
     
     try:
-        songs = get_user_songs(user_id)
+        songs = await db.run(get_user_songs, user_id)
         
         for song in songs:
-            song_db_id, name, song_url, song_id, created_at, last_checked = song
+            song_db_id, name, song_url, song_id, created_at, last_checked, tracked_song_id, videos_count = song
             
             logger.info(f"🔍 Проверяем новые видео для: {name}")
             
             # Реальный поиск новых видео
             videos = await get_videos_for_song(song_url, song_id, name, 20)
             
-            for video in videos:
-                if not get_video_exists(video['url']):
-                    if add_video(song_db_id, video):
-                        new_videos.append({
-                            'song_name': name,
-                            'video_url': video['url'],
-                            'description': video['description'],
-                            'author': video.get('author_name', video.get('author_username', 'Неизвестный автор'))
-                        })
-                        logger.info(f"🎉 Новое видео для {name}")
+            added_videos = await db.run(add_videos, tracked_song_id, videos, exclude_user_id=user_id)
+            for video in added_videos:
+                new_videos.append({
+                    'song_name': name,
+                    'video_url': video['url'],
+                    'description': video['description'],
+                    'author': video.get('author_name', video.get('author_username', 'Неизвестный автор'))
+                })
+            
+            if added_videos:
+                logger.info(f"🎉 Новых видео для {name}: {len(added_videos)}")
             
-            update_song_last_checked(song_db_id)
+            await db.run(update_song_last_checked, tracked_song_id)
         
     except Exception as e:
         logger.error(f"❌ Ошибка проверки видео: {e}")
@@ -740,25 +1948,21 @@ async def search_more_videos_for_song(song_id, song_name, user_id):
     try:
         logger.info(f"🔍 Дополнительный поиск для: {song_name}")
         
-        songs = get_user_songs(user_id)
-        song_info = next((s for s in songs if s[0] == song_id), None)
+        song_info = await db.run(get_user_song, song_id, user_id)
         
         if not song_info:
             return 0
             
         song_url = song_info[2]
         song_id_str = song_info[3]
+        tracked_song_id = song_info[6]
         
         # Реальный поиск дополнительных видео
         videos = await get_videos_for_song(song_url, song_id_str, song_name, 15)
         
-        new_videos_count = 0
-        for video in videos:
-            if not get_video_exists(video['url']):
-                if add_video(song_id, video):
-                    new_videos_count += 1
+        new_videos_count = len(await db.run(add_videos, tracked_song_id, videos, exclude_user_id=user_id))
         
-        update_song_last_checked(song_id)
+        await db.run(update_song_last_checked, tracked_song_id)
         
         return new_videos_count
         
@@ -830,7 +2034,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             await help_handler(update, context)
         elif data.startswith("delete_song:"):
             await delete_song_handler(update, context)
-        elif data.startswith("show_videos:"):
+        elif data.startswith("show_videos:") or data.startswith("videos_page:"):
             await show_videos_handler(update, context)
         elif data.startswith("search_more:"):
             await search_more_handler(update, context)
@@ -868,7 +2072,7 @@ async def list_songs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Список песен с количеством видео"""
     try:
         user_id = update.effective_user.id
-        songs = get_user_songs(user_id)
+        songs = await db.run(get_user_songs, user_id)
         
         if not songs:
             keyboard = InlineKeyboardMarkup([
@@ -882,10 +2086,7 @@ async def list_songs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         keyboard_buttons = []
         
         for song in songs:
-            song_id, name, song_url, song_id_str, created_at, last_checked = song
-            
-            # Получаем количество видео для песни
-            videos_count = get_song_videos_count(song_id, user_id)
+            song_id, name, song_url, song_id_str, created_at, last_checked, tracked_song_id, videos_count = song
             
             text += f"🎵 {name}\n"
             text += f"📊 Видео: {videos_count} | 🆔 ID: {song_id_str}\n"
@@ -907,42 +2108,64 @@ async def list_songs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         logger.error(f"❌ Ошибка показа списка песен: {e}")
 
+def video_page_callback(song_id, direction, video):
+    """callback_data кнопки листания: курсор (created_at, id) крайнего видео страницы"""
+    created_at, video_id = video[3], video[4]
+    timestamp = int(parse_db_timestamp(created_at) or 0)
+    return f"videos_page:{song_id}:{direction}:{timestamp}:{video_id}"
+
 async def show_videos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать видео с информацией"""
+    """Показать видео с информацией (постранично)"""
     try:
         query = update.callback_query
-        song_id = int(query.data.split(":")[1])
+        parts = query.data.split(":")
+        song_id = int(parts[1])
         user_id = update.effective_user.id
         
-        videos = get_song_videos(song_id, user_id, limit=10)
-        total_count = get_song_videos_count(song_id, user_id)
+        # videos_page:<песня>:<o|n>:<created_at unix>:<id> — курсор следующей/предыдущей страницы
+        direction = parts[2] if parts[0] == "videos_page" else None
+        cursor = None
+        if direction:
+            cursor = (datetime.fromtimestamp(int(parts[3]), timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), int(parts[4]))
         
-        # Получаем информацию о песне
-        songs = get_user_songs(user_id)
-        song_info = next((s for s in songs if s[0] == song_id), None)
+        song_info = await db.run(get_user_song, song_id, user_id)
         
         if not song_info:
             await query.edit_message_text("❌ Ошибка: песня не найдена")
             return
-            
+        
+        if direction == 'n':
+            videos = await db.run(get_song_videos, song_id, user_id, limit=VIDEOS_PAGE_SIZE + 1, after=cursor)
+            has_newer, has_older = len(videos) > VIDEOS_PAGE_SIZE, True
+            videos = videos[-VIDEOS_PAGE_SIZE:]
+        else:
+            videos = await db.run(get_song_videos, song_id, user_id, limit=VIDEOS_PAGE_SIZE + 1, before=cursor)
+            has_newer, has_older = direction == 'o', len(videos) > VIDEOS_PAGE_SIZE
+            videos = videos[:VIDEOS_PAGE_SIZE]
+        
         song_name = song_info[1]
+        total_count = song_info[7]
         
         if not videos:
             text = f"🎵 **{song_name}**\n📊 Всего видео: 0\n\n📭 Видео пока не найдено.\n\nНажмите '🔍 Искать видео' для поиска."
         else:
-            text = f"🎵 **{song_name}**\n📊 Всего видео: {total_count}\n\n**Последние видео:**\n\n"
+            title = "Последние видео" if not has_newer else "Видео"
+            text = f"🎵 **{song_name}**\n📊 Всего видео: {total_count}\n\n**{title}:**\n\n"
             
             for i, video in enumerate(videos, 1):
-                video_url, description, author, created_at = video
+                video_url, description, author, created_at, video_id = video
                 text += f"**{i}. {description}**\n"
                 text += f"👤 Автор: {author or 'Неизвестен'}\n"
                 text += f"🔗 [Смотреть видео]({video_url})\n"
                 text += f"⏰ Добавлено: {created_at[:16] if created_at else 'Недавно'}\n\n"
-            
-            if total_count > 10:
-                text += f"*... и ещё {total_count - 10} видео*"
         
-        keyboard = InlineKeyboardMarkup([
+        page_buttons = []
+        if videos and has_newer:
+            page_buttons.append(InlineKeyboardButton("⬅️ Новее", callback_data=video_page_callback(song_id, 'n', videos[0])))
+        if videos and has_older:
+            page_buttons.append(InlineKeyboardButton("Старее ➡️", callback_data=video_page_callback(song_id, 'o', videos[-1])))
+        
+        keyboard = InlineKeyboardMarkup(([page_buttons] if page_buttons else []) + [
             [InlineKeyboardButton("🔍 Искать ещё видео", callback_data=f"search_more:{song_id}")],
             [InlineKeyboardButton("🔄 Проверить новые", callback_data=f"check_song:{song_id}")],
             [InlineKeyboardButton("📋 К списку песен", callback_data="list_songs")],
@@ -962,8 +2185,7 @@ async def search_more_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         user_id = update.effective_user.id
         
         # Получаем информацию о песне
-        songs = get_user_songs(user_id)
-        song_info = next((s for s in songs if s[0] == song_id), None)
+        song_info = await db.run(get_user_song, song_id, user_id)
         
         if not song_info:
             await query.edit_message_text("❌ Ошибка: песня не найдена")
@@ -1006,15 +2228,16 @@ async def check_song_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = update.effective_user.id
         
         # Получаем информацию о песне
-        songs = get_user_songs(user_id)
-        song_info = next((s for s in songs if s[0] == song_id), None)
+        song_info = await db.run(get_user_song, song_id, user_id)
         
         if not song_info:
             await query.edit_message_text("❌ Ошибка: песня не найдена")
             return
             
         song_name = song_info[1]
+        song_url = song_info[2]
         song_id_str = song_info[3]
+        tracked_song_id = song_info[6]
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔄 Обновить", callback_data=f"check_song:{song_id}")],
@@ -1024,15 +2247,11 @@ async def check_song_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text(f"🔍 Проверяю новые видео для '{song_name}'...", reply_markup=keyboard)
         
         # Ищем новые видео
-        videos = await search_tiktok_videos(song_id_str, max_results=20)
+        videos = await get_videos_for_song(song_url, song_id_str, song_name, max_results=20)
         
-        new_videos_count = 0
-        for video in videos:
-            if not get_video_exists(video['url']):
-                if add_video(song_id, video):
-                    new_videos_count += 1
+        new_videos_count = len(await db.run(add_videos, tracked_song_id, videos, exclude_user_id=user_id))
         
-        update_song_last_checked(song_id)
+        await db.run(update_song_last_checked, tracked_song_id)
         
         if new_videos_count > 0:
             text = f"🎉 Для песни '{song_name}' найдено {new_videos_count} новых видео!"
@@ -1058,11 +2277,10 @@ async def delete_song_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         user_id = update.effective_user.id
         
         # Получаем информацию о песне для сообщения
-        songs = get_user_songs(user_id)
-        song_info = next((s for s in songs if s[0] == song_id), None)
+        song_info = await db.run(get_user_song, song_id, user_id)
         song_name = song_info[1] if song_info else "Неизвестная песня"
         
-        delete_song(song_id, user_id)
+        await db.run(delete_song, song_id, user_id)
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("📋 К списку песен", callback_data="list_songs")],
@@ -1149,8 +2367,14 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Обработчик текстовых сообщений"""
     try:
         text = update.message.text.strip()
-        
-        if any(domain in text for domain in ['tiktok.com', 'vm.tiktok.com']):
+        links = TIKTOK_LINK_RE.findall(text)
+        
+        if len(links) > 1:
+            await handle_song_links(update, context, links)
+        elif links:
+            # Из приложения ссылка приходит с подписью — берем только сам URL
+            await handle_song_link(update, context, links[0])
+        elif any(domain in text for domain in ['tiktok.com', 'vm.tiktok.com']):
             await handle_song_link(update, context, text)
         else:
             await update.message.reply_text(
@@ -1191,77 +2415,502 @@ async def handle_song_link(update: Update, context: ContextTypes.DEFAULT_TYPE, l
         logger.error(f"❌ Ошибка обработки ссылки: {e}")
         await update.message.reply_text("❌ Произошла ошибка при обработке ссылки.")
 
+async def handle_song_links(update: Update, context: ContextTypes.DEFAULT_TYPE, links):
+    """Пакетное добавление нескольких ссылок из одного сообщения"""
+    try:
+        progress_message = await update.message.reply_text(f"🔍 Распознаю ссылки: {len(links)}...")
+        
+        # Все ссылки разрешаются параллельно; дальше process_song_link берет их из кэша
+        await resolve_song_links(links)
+        
+        results = []
+        for link in links:
+            success, result_message = await process_song_link(update.effective_user.id, link)
+            results.append(result_message.split('\n', 1)[0].replace('*', ''))
+        
+        await progress_message.edit_text('\n'.join(results), reply_markup=get_main_keyboard())
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка пакетной обработки ссылок: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при обработке ссылок.")
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error("Exception while handling an update:", exc_info=context.error)
 
+# ========== РАСПИСАНИЕ ПРОВЕРОК ==========
+
+def parse_db_timestamp(value):
+    """Перевод TIMESTAMP из SQLite (UTC) в unix-время"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+def compute_poll_interval(previous_interval, recent_videos, new_videos):
+    """Интервал до следующей проверки по наблюдаемой активности звука.
+
+    Активные звуки опрашиваются так, чтобы за интервал появлялось около
+    POLL_TARGET_NEW_VIDEOS новых видео; у затихших звуков интервал растет
+    экспоненциально. Результат ограничен [POLL_MIN_INTERVAL, POLL_MAX_INTERVAL].
+    """
+    previous_interval = previous_interval or CHECK_INTERVAL
+    
+    if recent_videos > 0 and new_videos > 0:
+        # Активность только сокращает интервал; растет он лишь у затихших звуков
+        rate = recent_videos / POLL_ACTIVITY_WINDOW
+        interval = min(POLL_TARGET_NEW_VIDEOS / rate, previous_interval)
+    elif recent_videos > 0:
+        # Звук жив, но эта проверка ничего не дала — плавно отодвигаем
+        interval = min(POLL_TARGET_NEW_VIDEOS * POLL_ACTIVITY_WINDOW / recent_videos, previous_interval * POLL_BACKOFF_FACTOR)
+    else:
+        interval = previous_interval * POLL_BACKOFF_FACTOR
+    
+    return int(max(POLL_MIN_INTERVAL, min(POLL_MAX_INTERVAL, interval)))
+
+def with_jitter(interval):
+    """Случайный разброс, чтобы проверки не собирались в пачки"""
+    return interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+class PollScheduler:
+    """Очередь с приоритетом: звуки упорядочены по времени следующей проверки"""
+
+    def __init__(self):
+        self._heap = []
+        self._next_check = {}
+
+    def schedule(self, song_id, when):
+        self._next_check[song_id] = when
+        heapq.heappush(self._heap, (when, song_id))
+
+    def sync(self, songs, now=None):
+        """Добавление новых звуков (по last_checked + poll_interval) и удаление исчезнувших"""
+        now = now or time.time()
+        active_ids = set()
+        
+        for song in songs:
+            song_id, last_checked, poll_interval = song[0], song[4], song[5]
+            active_ids.add(song_id)
+            if song_id not in self._next_check:
+                last_checked_ts = parse_db_timestamp(last_checked)
+                if last_checked_ts is None:
+                    self.schedule(song_id, now)
+                else:
+                    self.schedule(song_id, last_checked_ts + with_jitter(poll_interval or CHECK_INTERVAL))
+        
+        for song_id in list(self._next_check):
+            if song_id not in active_ids:
+                del self._next_check[song_id]
+
+    def pop_due(self, now=None):
+        """ID звуков, время проверки которых наступило"""
+        now = now or time.time()
+        due = []
+        
+        while self._heap and self._heap[0][0] <= now:
+            when, song_id = heapq.heappop(self._heap)
+            # Устаревшие записи (перепланированные или удаленные звуки) пропускаем
+            if self._next_check.get(song_id) == when:
+                del self._next_check[song_id]
+                due.append(song_id)
+        
+        return due
+
+    def next_due_at(self):
+        """Время ближайшей запланированной проверки или None"""
+        while self._heap and self._next_check.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+poll_scheduler = PollScheduler()
+
+# ========== УВЕДОМЛЕНИЯ ==========
+
+def format_digest_song(name, videos):
+    """Строки сводки для одной песни (не больше DIGEST_MAX_VIDEOS_PER_SONG видео).
+
+    Возвращает список (строка, ID уведомлений): к строке видео привязано его
+    уведомление, к строке «... и ещё» — уведомления не показанных видео.
+    """
+    lines = [(f"🎵 *{escape_markdown(name[:200])}* — новых видео: {len(videos)}\n", [])]
+    
+    for video in videos[:DIGEST_MAX_VIDEOS_PER_SONG]:
+        # escape_markdown (v1) не экранирует «]», а в тексте ссылки она закрывает ссылку
+        description = escape_markdown(video['description'][:100].replace(']', ')'))
+        author = escape_markdown(video.get('author_username') or 'Неизвестный автор')
+        ids = [video['notification_id']] if video.get('notification_id') is not None else []
+        lines.append((f"• [{description}]({video['url']}) — 👤 {author}\n", ids))
+    
+    hidden = videos[DIGEST_MAX_VIDEOS_PER_SONG:]
+    if hidden:
+        ids = [video['notification_id'] for video in hidden if video.get('notification_id') is not None]
+        lines.append((f"_... и ещё {len(hidden)} видео_\n", ids))
+    
+    lines.append(("\n", []))
+    return lines
+
+def build_digest_messages(song_updates):
+    """Сводка для пользователя, разбитая на сообщения в пределах лимита Telegram.
+
+    song_updates — список (subscription_id, name, videos). Возвращает список
+    (text, reply_markup, notification_ids); к каждому сообщению прикреплены
+    кнопки «ещё» для песен, у которых новых видео больше, чем помещается
+    в сводку, и ID уведомлений, которые оно доставляет.
+    """
+    total = sum(len(videos) for _, _, videos in song_updates)
+    header = f"🎉 Новые видео с вашими песнями: {total}\n\n"
+    
+    messages = []
+    text, buttons, ids = header, [], []
+    
+    def flush():
+        messages.append((text, InlineKeyboardMarkup(buttons) if buttons else None, ids))
+    
+    for subscription_id, name, videos in song_updates:
+        lines = format_digest_song(name, videos)
+        block_length = sum(len(line) for line, _ in lines)
+        
+        if len(text) + block_length > DIGEST_MESSAGE_LIMIT and text != header:
+            flush()
+            text, buttons, ids = "", [], []
+        
+        # Блок длиннее лимита делим только по строкам, чтобы не разорвать Markdown-разметку
+        for line, line_ids in lines:
+            if len(text) + len(line) > DIGEST_MESSAGE_LIMIT and text:
+                flush()
+                text, buttons, ids = "", [], []
+            text += line
+            ids = ids + line_ids
+        if len(videos) > DIGEST_MAX_VIDEOS_PER_SONG:
+            buttons.append([InlineKeyboardButton(f"📹 Ещё видео: {name}"[:60], callback_data=f"show_videos:{subscription_id}")])
+    
+    flush()
+    return messages
+
+_outbox_event = None
+_outbox_task = None
+_chat_buckets = {}
+
+def wake_notification_worker():
+    """Разбудить отправщика, не дожидаясь OUTBOX_POLL_INTERVAL"""
+    if _outbox_event is not None:
+        _outbox_event.set()
+
+def get_chat_bucket(chat_id):
+    """Ограничитель частоты сообщений в один чат"""
+    if chat_id not in _chat_buckets:
+        if len(_chat_buckets) > 10000:
+            _chat_buckets.clear()
+        _chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RPS, 1)
+    return _chat_buckets[chat_id]
+
+def group_notifications(rows):
+    """Строки очереди -> {user_id: [(subscription_id, name, videos, notification_ids)]}"""
+    by_user = {}
+    
+    for notification_id, user_id, subscription_id, name, attempts, video_url, description, author_username in rows:
+        songs = by_user.setdefault(user_id, OrderedDict())
+        if subscription_id not in songs:
+            songs[subscription_id] = (name, [], [])
+        songs[subscription_id][1].append({
+            'url': video_url,
+            'description': description or '',
+            'author_username': author_username,
+            'notification_id': notification_id
+        })
+        songs[subscription_id][2].append(notification_id)
+    
+    return {
+        user_id: [(subscription_id, name, videos, ids) for subscription_id, (name, videos, ids) in songs.items()]
+        for user_id, songs in by_user.items()
+    }
+
+async def deliver_user_digest(bot, global_bucket, user_id, song_updates):
+    """Отправка сводки одному пользователю; возвращает True, если доставлена целиком.
+
+    Каждое сообщение сводки помечает свои уведомления сразу после отправки,
+    поэтому ошибка на k-м сообщении не повторит уже отправленные.
+    """
+    messages = build_digest_messages([(sid, name, videos) for sid, name, videos, _ in song_updates])
+    chat_bucket = get_chat_bucket(user_id)
+    
+    for index, (text, reply_markup, message_ids) in enumerate(messages):
+        # Уведомления этого и последующих сообщений — еще не отправлены
+        notification_ids = [nid for _, _, ids in messages[index:] for nid in ids]
+        while True:
+            await global_bucket.acquire()
+            await chat_bucket.acquire()
+            try:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=text,
+                    reply_markup=reply_markup,
+                    parse_mode='Markdown',
+                    disable_web_page_preview=True
+                )
+                break
+            except RetryAfter as e:
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} с")
+                global_bucket.block(float(e.retry_after))
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или сообщение не принимается — повтор не поможет
+                logger.warning(f"⚠️ Уведомление пользователю {user_id} не доставлено: {e}")
+                await db.run(mark_notifications_failed, notification_ids, e, background=True)
+                return False
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки уведомления пользователю {user_id}: {e}")
+                await db.run(mark_notifications_failed, notification_ids, e, retry_in=OUTBOX_POLL_INTERVAL, background=True)
+                return False
+        
+        await db.run(mark_notifications_delivered, message_ids, background=True)
+    
+    return True
+
+async def drain_notification_outbox(bot, global_bucket):
+    """Отправка всех готовых уведомлений из очереди; возвращает число сводок
+    
+    Доставка «хотя бы один раз»: строка помечается после отправки, поэтому
+    падение между отправкой и отметкой (или ошибка отметки) повторит сводку
+    при следующем опросе. Внутри одного прохода каждая строка отправляется
+    не более одного раза.
+    """
+    delivered = 0
+    handled_ids = set()
+    
+    while True:
+        rows = await db.run(get_pending_notifications, OUTBOX_BATCH_SIZE, DIGEST_WINDOW, background=True)
+        # Строки, которые не удалось пометить, остаются pending — не шлем их повторно в этом проходе
+        rows = [row for row in rows if row[0] not in handled_ids]
+        if not rows:
+            return delivered
+        handled_ids.update(row[0] for row in rows)
+        
+        for user_id, song_updates in group_notifications(rows).items():
+            if await deliver_user_digest(bot, global_bucket, user_id, song_updates):
+                delivered += 1
+
+async def notification_worker(application):
+    """Фоновый отправщик очереди уведомлений"""
+    global _outbox_event
+    
+    _outbox_event = asyncio.Event()
+    global_bucket = TokenBucket(TELEGRAM_GLOBAL_RPS, TELEGRAM_GLOBAL_RPS)
+    
+    while True:
+        _outbox_event.clear()
+        try:
+            # Уведомления пользователя копятся DIGEST_WINDOW секунд (см. get_pending_notifications)
+            delivered = await drain_notification_outbox(application.bot, global_bucket)
+            if delivered:
+                logger.info(f"📨 Отправлено сводок: {delivered}")
+                await db.run(purge_delivered_notifications, OUTBOX_RETENTION_DAYS, background=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправщика уведомлений: {e}")
+        
+        try:
+            await asyncio.wait_for(_outbox_event.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start_notification_worker(application):
+    """Запуск отправщика уведомлений"""
+    global _outbox_task
+    
+    if _outbox_task is None or _outbox_task.done():
+        _outbox_task = asyncio.get_running_loop().create_task(notification_worker(application))
+
+async def stop_notification_worker():
+    """Остановка отправщика уведомлений"""
+    global _outbox_task
+    
+    if _outbox_task is not None and not _outbox_task.done():
+        _outbox_task.cancel()
+        try:
+            await _outbox_task
+        except asyncio.CancelledError:
+            pass
+    _outbox_task = None
+
 # ========== ПЕРИОДИЧЕСКАЯ ПРОВЕРКА ==========
 
+async def check_song_for_updates(song, subscribers, recent_videos=0):
+    """Проверка одного звука: один запрос к TikTok на всех подписчиков; возвращает новые видео"""
+    tracked_song_id, name, song_url, song_id_str, last_checked, poll_interval, high_water_mark = song
+    
+    logger.info(f"🔍 Проверяем новые видео для песни: {name} (подписчиков: {len(subscribers)})")
+    
+    # Отметку двигает только завершенный обход списка звука (см. crawl_music_item_list)
+    crawl_state = {}
+    videos = await get_videos_for_song(song_url, song_id_str, name, max_results=20,
+                                       high_water_mark=high_water_mark, crawl_state=crawl_state)
+    
+    # Одна транзакция на всю выдачу; в ответ — только новые видео
+    new_videos = await db.run(add_videos, tracked_song_id, videos, background=True)
+    new_videos_count = len(new_videos)
+    
+    # Следующая проверка — по наблюдаемой активности звука
+    next_interval = compute_poll_interval(poll_interval, recent_videos + new_videos_count, new_videos_count)
+    await db.run(update_song_last_checked, tracked_song_id, next_interval, crawl_state.get('high_water_mark'), background=True)
+    poll_scheduler.schedule(tracked_song_id, time.time() + with_jitter(next_interval))
+    
+    if new_videos_count > 0:
+        logger.info(f"✅ Для песни '{name}' найдено {new_videos_count} новых видео")
+    
+    return new_videos
+
 async def periodic_check(context):
     """Периодическая проверка только НОВЫХ видео"""
     logger.info("🔍 Запуск автоматической проверки НОВЫХ видео...")
     
     try:
-        songs = get_all_songs_for_checking()
-        total_new_videos = 0
+        all_songs = await db.run(get_all_songs_for_checking, background=True)
+        poll_scheduler.sync(all_songs)
         
-        for song in songs:
-            song_id, user_id, name, song_url, song_id_str = song
-            
-            logger.info(f"🔍 Проверяем новые видео для песни: {name}")
-            
-            videos = await search_tiktok_videos(song_id_str, max_results=20)
-            new_videos_count = 0
-            
-            for video in videos:
-                # Проверяем, что видео новое (еще не в базе)
-                if not get_video_exists(video['url']):
-                    if add_video(song_id, video):
-                        new_videos_count += 1
-                        total_new_videos += 1
-                        
-                        # Отправляем уведомление пользователю
-                        try:
-                            await context.bot.send_message(
-                                chat_id=user_id,
-                                text=f"🎉 Новое видео с вашей песней!\n\n"
-                                     f"🎵 **{name}**\n"
-                                     f"📹 {video['description']}\n"
-                                     f"👤 {video.get('author_username', 'Неизвестный автор')}\n"
-                                     f"🔗 [Смотреть видео]({video['url']})",
-                                parse_mode='Markdown'
-                            )
-                            # Задержка между сообщениями
-                            await asyncio.sleep(1)
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка отправки уведомления: {e}")
-            
-            update_song_last_checked(song_id)
-            
-            if new_videos_count > 0:
-                logger.info(f"✅ Для песни '{name}' найдено {new_videos_count} новых видео")
+        due_ids = set(poll_scheduler.pop_due())
+        songs = [song for song in all_songs if song[0] in due_ids]
+        subscribers = await db.run(get_song_subscribers, background=True)
+        recent_counts = await db.run(get_recent_video_counts, POLL_ACTIVITY_WINDOW, background=True)
+        semaphore = asyncio.Semaphore(CHECK_CONCURRENCY)
+        
+        async def check_with_limits(song):
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(
+                        check_song_for_updates(song, subscribers.get(song[0], []), recent_counts.get(song[0], 0)),
+                        timeout=SONG_CHECK_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning(f"⏱ Проверка песни '{song[1]}' прервана: превышен лимит {SONG_CHECK_TIMEOUT:.0f} с")
+                except Exception as e:
+                    logger.error(f"❌ Ошибка проверки песни '{song[1]}': {e}")
+                
+                # Неудачную проверку повторяем через обычный интервал звука
+                poll_scheduler.schedule(song[0], time.time() + with_jitter(song[5] or CHECK_INTERVAL))
+                return []
+        
+        logger.info(f"📋 Звуков к проверке: {len(songs)} из {len(all_songs)}, параллельно: {CHECK_CONCURRENCY}")
+        results = await asyncio.gather(*(check_with_limits(song) for song in songs))
+        total_new_videos = sum(len(new_videos) for new_videos in results)
+        
+        # Уведомления уже в очереди; сводка уйдет, когда истечет окно DIGEST_WINDOW пользователя
+        if total_new_videos:
+            wake_notification_worker()
         
         logger.info(f"✅ Автоматическая проверка завершена. Найдено {total_new_videos} новых видео")
+        logger.info(f"🧠 Индекс видео: {seen_videos.stats()}")
+        logger.info(f"🗂 Кэш ответов: {response_cache.stats()}")
+        logger.info(f"📊 Эндпоинты: {endpoint_scoreboard.stats()}")
+        logger.info(f"🗄 Запросы к БД: {db.stats()}")
+        logger.info(f"📦 Кэш чтения: {read_cache.stats()}")
         
     except Exception as e:
         logger.error(f"❌ Ошибка периодической проверки: {e}")
 
-def start_periodic_checking(application):
-    """Запуск периодической проверки"""
+# Состояние цикла проверки (время в unix-секундах)
+check_cycle_state = {
+    'running': False,
+    'started_at': None,
+    'finished_at': None,
+    'duration': None,
+    'next_run_at': None,
+    'skipped': 0,
+}
+
+_check_task = None
+
+async def run_check_cycle(application):
+    """Один цикл проверки; параллельный запуск второго цикла пропускается"""
+    if check_cycle_state['running']:
+        check_cycle_state['skipped'] += 1
+        logger.warning("⏭ Предыдущая проверка еще идет — запуск пропущен")
+        return False
+    
+    check_cycle_state['running'] = True
+    check_cycle_state['started_at'] = time.time()
     try:
-        scheduler = BackgroundScheduler()
-        trigger = IntervalTrigger(minutes=30)  # Проверка каждые 30 минут
-        scheduler.add_job(
-            lambda: asyncio.create_task(periodic_check(application)),
-            trigger=trigger
-        )
-        scheduler.start()
-        logger.info("✅ Периодическая проверка запущена (каждые 30 минут)")
-    except Exception as e:
-        logger.error(f"❌ Ошибка запуска периодической проверки: {e}")
+        await periodic_check(application)
+    finally:
+        check_cycle_state['finished_at'] = time.time()
+        check_cycle_state['duration'] = check_cycle_state['finished_at'] - check_cycle_state['started_at']
+        check_cycle_state['running'] = False
+    
+    return True
+
+def get_next_cycle_delay(cycle_duration):
+    """Пауза до следующего цикла: не позже CHECK_INTERVAL от начала текущего,
+    раньше — если у планировщика есть звуки с более ранним сроком"""
+    delay = CHECK_INTERVAL - cycle_duration
+    
+    next_due = poll_scheduler.next_due_at()
+    if next_due is not None:
+        delay = min(delay, next_due - time.time())
+    
+    if cycle_duration > CHECK_INTERVAL:
+        logger.warning(f"⚠️ Проверка заняла {cycle_duration:.0f} с при интервале {CHECK_INTERVAL} с — следующий цикл сокращен")
+    
+    # Затянувшийся цикл не запускает следующий вплотную
+    return max(delay, CHECK_MIN_PAUSE)
+
+async def periodic_check_loop(application):
+    """Цикл периодической проверки внутри event loop бота"""
+    await asyncio.sleep(CHECK_MIN_PAUSE)
+    
+    while True:
+        cycle_started = time.monotonic()
+        try:
+            await run_check_cycle(application)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка цикла проверки: {e}")
+        
+        delay = get_next_cycle_delay(time.monotonic() - cycle_started)
+        check_cycle_state['next_run_at'] = time.time() + delay
+        logger.info(f"⏰ Следующая проверка через {delay:.0f} с")
+        await asyncio.sleep(delay)
+
+def start_periodic_checking(application):
+    """Запуск периодической проверки в event loop бота"""
+    global _check_task
+    
+    if _check_task is not None and not _check_task.done():
+        return
+    
+    _check_task = asyncio.get_running_loop().create_task(periodic_check_loop(application))
+    logger.info(f"✅ Периодическая проверка запущена (интервал {CHECK_INTERVAL} с)")
+
+async def stop_periodic_checking():
+    """Остановка цикла периодической проверки"""
+    global _check_task
+    
+    if _check_task is not None and not _check_task.done():
+        _check_task.cancel()
+        try:
+            await _check_task
+        except asyncio.CancelledError:
+            pass
+    _check_task = None
 
 # ========== ЗАПУСК БОТА ==========
 
+async def on_startup(application):
+    """Запуск фоновых задач после инициализации бота"""
+    start_notification_worker(application)
+    start_periodic_checking(application)
+
+async def on_shutdown(application):
+    """Освобождение ресурсов при остановке бота"""
+    await stop_periodic_checking()
+    await stop_notification_worker()
+    await close_http_session()
+    shutdown_parse_executor()
+    db.close()
+    logger.info("🛑 HTTP-клиент и соединения с БД закрыты")
+
 def main():
     """Основная функция запуска бота"""
     max_retries = 3
@@ -1280,18 +2929,22 @@ def main():
                 
             # Инициализация БД
             init_db()
+            seen_videos.warm()
             
             # Создание приложения
-            application = Application.builder().token(BOT_TOKEN).build()
+            application = (
+                Application.builder()
+                .token(BOT_TOKEN)
+                .post_init(on_startup)
+                .post_shutdown(on_shutdown)
+                .build()
+            )
             
             # Обработчики
             application.add_handler(CommandHandler("start", start))
             application.add_handler(CallbackQueryHandler(handle_menu_callback))
             application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
             
-            # Периодическая проверка
-            start_periodic_checking(application)
-            
             # Обработчик ошибок
             application.add_error_handler(error_handler)
             
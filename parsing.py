@@ -0,0 +1,367 @@
+import logging
+import json
+import html
+import re
+from datetime import datetime
+
+try:
+    import orjson  # необязательный ускоренный декодер JSON
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Разбор ответов TikTok. Модуль не зависит от telegram и aiohttp: функции
+# отсюда выполняются в пуле разбора (см. run_parser в main.py)
+
+# ========== HTML ==========
+
+TIKTOK_BASE_URL = 'https://www.tiktok.com'
+
+# Ссылки на видео в тексте страницы; вложенный «video/<id>» учитывается отдельно
+HTML_LINK_PATTERN = (
+    r'(?P<full>https://www\.tiktok\.com/@[^/]+/video/(?P<full_id>\d+))'
+    r'|href="(?P<relative>/@[^/]+/video/(?P<relative_id>\d+))"'
+    r'|video/(?P<bare_id>\d+)'
+)
+HTML_LINK_RE = re.compile(HTML_LINK_PATTERN)
+HTML_VIDEO_RE = re.compile(
+    r'(?P<anchor>(?i:<a\s[^>]*?\bhref\s*=\s*)(?:"(?P<href_dq>[^"]*)"|\'(?P<href_sq>[^\']*)\'|(?P<href_bare>[^\s"\'>]+)))'
+    r'|' + HTML_LINK_PATTERN
+)
+VIDEO_ID_IN_HREF_RE = re.compile(r'video/(\d+)')
+
+# Один вызов re держит GIL на весь просмотр, поэтому большие страницы сканируем
+# окнами: в пуле потоков event loop ждет не дольше разбора одного окна.
+# Перекрытие окон больше любой ссылки или тега <a>, который ищет HTML_VIDEO_RE
+HTML_SCAN_CHUNK = 64 * 1024
+HTML_SCAN_OVERLAP = 16 * 1024
+
+# Встроенные данные гидратации: <script id="...">{JSON}</script>
+HYDRATION_SCRIPT_IDS = ('__UNIVERSAL_DATA_FOR_REHYDRATION__', 'SIGI_STATE')
+
+def decode_json(raw):
+    """Декодирование JSON через orjson, если он установлен"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def slice_hydration_json(html_content):
+    """Вырезает текст JSON из скрипта гидратации без разбора остальной страницы"""
+    for script_id in HYDRATION_SCRIPT_IDS:
+        for marker in (f'id="{script_id}"', f"id='{script_id}'"):
+            position = html_content.find(marker)
+            if position == -1:
+                continue
+            start = html_content.find('>', position)
+            end = html_content.find('</script>', start) if start != -1 else -1
+            if end != -1:
+                return script_id, html_content[start + 1:end]
+    return None, None
+
+def iter_hydration_items(script_id, data):
+    """Элементы-видео по известным путям данных гидратации"""
+    if not isinstance(data, dict):
+        return
+    
+    if script_id == 'SIGI_STATE':
+        item_module = data.get('ItemModule')
+        if isinstance(item_module, dict):
+            yield from item_module.values()
+        return
+    
+    scope = data.get('__DEFAULT_SCOPE__')
+    if not isinstance(scope, dict):
+        return
+    for page_data in scope.values():
+        if not isinstance(page_data, dict):
+            continue
+        item_struct = (page_data.get('itemInfo') or {}).get('itemStruct')
+        if isinstance(item_struct, dict):
+            yield item_struct
+        for key in ('itemList', 'items'):
+            items = page_data.get(key)
+            if isinstance(items, list):
+                yield from items
+
+def create_video_from_item(item):
+    """Запись видео из элемента TikTok (itemStruct) с настоящим автором и датой"""
+    if not isinstance(item, dict):
+        return None
+    
+    # Поля web-API (id, createTime) и мобильного API (aweme_id, create_time)
+    video_id = str(item.get('id') or item.get('aweme_id') or '')
+    if not video_id.isdigit():
+        return None
+    
+    author = item.get('author')
+    if isinstance(author, dict):
+        author_username = author.get('uniqueId') or author.get('unique_id') or 'unknown'
+        author_name = author.get('nickname') or author_username
+    else:
+        # В SIGI_STATE автор хранится строкой, а ник — рядом
+        author_username = author or 'unknown'
+        author_name = item.get('nickname') or author_username
+    
+    description = item.get('desc') or f'Видео {video_id}'
+    if len(description) > 200:
+        description = description[:200] + '...'
+    
+    try:
+        created_at = datetime.fromtimestamp(int(item.get('createTime') or item.get('create_time')))
+    except (TypeError, ValueError, OverflowError, OSError):
+        created_at = datetime.now()
+    
+    url_username = author_username if author_username != 'unknown' else 'user'
+    return {
+        'url': f"{TIKTOK_BASE_URL}/@{url_username}/video/{video_id}",
+        'description': description,
+        'author_username': author_username,
+        'author_name': author_name,
+        'video_id': video_id,
+        'created_at': created_at
+    }
+
+def extract_videos_from_hydration(html_content):
+    """Видео из встроенного JSON страницы; пустой список, если его нет"""
+    videos = []
+    
+    try:
+        script_id, raw_json = slice_hydration_json(html_content)
+        if raw_json is None:
+            return videos
+        
+        seen_urls = set()
+        for item in iter_hydration_items(script_id, decode_json(raw_json)):
+            video = create_video_from_item(item)
+            if video and video['url'] not in seen_urls:
+                seen_urls.add(video['url'])
+                videos.append(video)
+        
+    except ValueError as e:
+        logger.debug(f"⚠️ Не удалось декодировать данные гидратации: {e}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка извлечения данных гидратации: {e}")
+    
+    return videos
+
+def _collect_html_links(match, full_links, relative_links, bare_ids):
+    """Раскладка совпадения по группам в порядке старых трех проходов regex"""
+    if match.group('full'):
+        full_links.append(match.group('full'))
+        bare_ids.append(match.group('full_id'))
+    elif match.group('relative'):
+        relative_links.append(match.group('relative'))
+        bare_ids.append(match.group('relative_id'))
+    else:
+        bare_ids.append(match.group('bare_id'))
+
+def iter_html_matches(html_content):
+    """Совпадения HTML_VIDEO_RE в том же порядке, что и finditer, но поиском по окнам.
+
+    Совпадение принимается, только если начинается до конца окна без
+    перекрытия: тогда оно целиком помещается в окно и не обрезано его границей.
+    """
+    length = len(html_content)
+    position = 0
+    
+    while position < length:
+        safe_end = position + HTML_SCAN_CHUNK
+        window_end = min(length, safe_end + HTML_SCAN_OVERLAP)
+        match = HTML_VIDEO_RE.search(html_content, position, window_end)
+        
+        if match is None or (match.start() >= safe_end and window_end < length):
+            if window_end == length:
+                return
+            position = safe_end
+            continue
+        
+        yield match
+        position = match.end()
+
+def extract_videos_from_html(html_content):
+    """Извлечение видео из HTML страницы за один проход без построения DOM"""
+    # Встроенный JSON дает настоящих авторов и даты — текст страницы не сканируем
+    videos = extract_videos_from_hydration(html_content)
+    if videos:
+        return videos
+    
+    try:
+        full_links, relative_links, bare_ids, anchor_hrefs = [], [], [], []
+        
+        for match in iter_html_matches(html_content):
+            if match.group('anchor'):
+                # Тег <a> целиком поглощен совпадением — ищем ссылки внутри него
+                for inner in HTML_LINK_RE.finditer(match.group('anchor')):
+                    _collect_html_links(inner, full_links, relative_links, bare_ids)
+                href = match.group('href_dq')
+                if href is None:
+                    href = match.group('href_sq') if match.group('href_sq') is not None else match.group('href_bare')
+                href = html.unescape(href)
+                if '/video/' in href:
+                    anchor_hrefs.append(href)
+            else:
+                _collect_html_links(match, full_links, relative_links, bare_ids)
+        
+        # Порядок и дедупликация по URL — как у прежней реализации
+        candidates = []
+        candidates.extend((url, url, f'Видео с песней (ID: {url})') for url in full_links)
+        candidates.extend((f"{TIKTOK_BASE_URL}{path}", path, f'Видео с песней (ID: {path})') for path in relative_links)
+        candidates.extend((f"{TIKTOK_BASE_URL}/@user/video/{video_id}", video_id, f'Видео с песней (ID: {video_id})') for video_id in bare_ids)
+        for href in anchor_hrefs:
+            video_id = VIDEO_ID_IN_HREF_RE.search(href)
+            video_url = f"{TIKTOK_BASE_URL}{href}" if href.startswith('/') else href
+            candidates.append((video_url, video_id.group(1) if video_id else 'unknown', 'Видео с TikTok'))
+        
+        now = datetime.now()
+        seen_urls = set()
+        for video_url, video_id, description in candidates:
+            if video_url in seen_urls:
+                continue
+            seen_urls.add(video_url)
+            videos.append({
+                'url': video_url,
+                'description': description,
+                'author_username': 'unknown',
+                'author_name': 'TikTok пользователь',
+                'video_id': video_id,
+                'created_at': now
+            })
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка извлечения видео из HTML: {e}")
+    
+    return videos
+
+# ========== JSON ==========
+
+# Известные списки видео в ответах TikTok и глубина запасного обхода
+JSON_ITEM_LIST_KEYS = ('itemList', 'items', 'aweme_list')
+JSON_WRAPPER_KEYS = ('data', 'body')
+JSON_WALK_MAX_DEPTH = 12
+
+def iter_known_item_lists(data):
+    """Списки видео по прямым путям: корень и обертки data/body"""
+    if not isinstance(data, dict):
+        return
+    containers = [data] + [data[key] for key in JSON_WRAPPER_KEYS if isinstance(data.get(key), dict)]
+    for container in containers:
+        for key in JSON_ITEM_LIST_KEYS:
+            items = container.get(key)
+            if isinstance(items, list):
+                yield items
+
+def looks_like_video(obj):
+    """Признаки объекта-видео; у автора, музыки и хештегов их нет"""
+    if 'aweme_id' in obj or 'itemId' in obj or 'videoUrl' in obj or 'webVideoUrl' in obj:
+        return True
+    return 'id' in obj and isinstance(obj.get('video'), dict)
+
+def video_from_json_item(item):
+    """Запись видео из элемента ответа API; пользователи, музыка и хештеги отсекаются"""
+    if not looks_like_video(item):
+        return None
+    return create_video_from_item(item) or create_video_data(item)
+
+def iter_videos_from_json(data, max_depth=JSON_WALK_MAX_DEPTH):
+    """Генератор видео: сначала известные схемы, затем обход с ограничением глубины"""
+    found = False
+    for items in iter_known_item_lists(data):
+        for item in items:
+            if isinstance(item, dict):
+                video = video_from_json_item(item)
+                if video:
+                    found = True
+                    yield video
+    if found:
+        return
+    
+    # Итеративный обход без рекурсии: глубоко вложенный ответ не упрется в лимит стека
+    stack = [(data, 0)]
+    while stack:
+        obj, depth = stack.pop()
+        if isinstance(obj, dict):
+            if looks_like_video(obj):
+                video = video_from_json_item(obj)
+                if video:
+                    yield video
+                continue
+            children = list(obj.values())
+        elif isinstance(obj, list):
+            children = obj
+        else:
+            continue
+        
+        if depth < max_depth:
+            stack.extend((child, depth + 1) for child in reversed(children) if isinstance(child, (dict, list)))
+
+def extract_from_json_structure(data):
+    """Извлечение видео из различных JSON структур"""
+    videos = []
+    seen_urls = set()
+    
+    for video in iter_videos_from_json(data):
+        if video['url'] not in seen_urls:
+            seen_urls.add(video['url'])
+            videos.append(video)
+    
+    return videos
+
+def create_video_data(item):
+    """Создание данных видео из элемента"""
+    try:
+        video_id = item.get('id') or item.get('itemId') or 'unknown'
+        
+        # URL видео
+        video_url = None
+        if 'video' in item and 'downloadAddr' in item['video']:
+            video_url = item['video']['downloadAddr']
+        elif 'videoUrl' in item:
+            video_url = item['videoUrl']
+        elif 'webVideoUrl' in item:
+            video_url = item['webVideoUrl']
+        else:
+            video_url = f"https://www.tiktok.com/@user/video/{video_id}"
+        
+        # Описание
+        description = item.get('desc') or item.get('description') or f'Видео {video_id}'
+        if len(description) > 200:
+            description = description[:200] + '...'
+        
+        # Автор
+        author = item.get('author', {})
+        author_username = author.get('uniqueId', 'unknown')
+        author_name = author.get('nickname', 'Неизвестный автор')
+        
+        return {
+            'url': video_url,
+            'description': description,
+            'author_username': author_username,
+            'author_name': author_name,
+            'video_id': video_id,
+            'created_at': datetime.now()
+        }
+        
+    except Exception as e:
+        logger.debug(f"⚠️ Ошибка создания данных видео: {e}")
+        return None
+
+# ========== ФУНКЦИИ ПУЛА РАЗБОРА ==========
+
+# Функции разбора принимают байты тела и выполняются в пуле, поэтому должны быть
+# определены на уровне модуля (передаются в процесс по имени)
+
+def parse_html_payload(content, encoding):
+    """Видео со страницы поиска"""
+    return extract_videos_from_html(content.decode(encoding, errors='replace'))
+
+def parse_json_videos_payload(content, encoding):
+    """Видео из ответа JSON API"""
+    return extract_from_json_structure(decode_json(content))
+
+def parse_item_list_payload(content, encoding):
+    """Страница списка видео звука: (видео, есть ли еще, курсор)"""
+    data = decode_json(content)
+    if not isinstance(data, dict):
+        return extract_from_json_structure(data), False, None
+    return extract_from_json_structure(data), bool(data.get('hasMore')), data.get('cursor')
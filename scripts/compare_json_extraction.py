@@ -0,0 +1,97 @@
+"""Сравнение старого рекурсивного и нового извлечения видео из JSON.
+
+Запуск из корня репозитория:
+    python scripts/compare_json_extraction.py
+
+Записанных ответов TikTok в репозитории нет, поэтому используются
+синтетические ответы в формах web-API (itemList), мобильного API
+(aweme_list) и произвольной вложенности. Для каждого печатается число
+записей, число ложных срабатываний (не видео) и время разбора.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing  # noqa: E402
+
+def legacy_extract(data):
+    """Прежняя реализация extract_from_json_structure"""
+    videos = []
+
+    def find_videos(obj, path=""):
+        if isinstance(obj, dict):
+            if any(key in obj for key in ['video', 'itemId', 'id', 'videoUrl', 'webVideoUrl']):
+                video_data = parsing.create_video_data(obj)
+                if video_data:
+                    videos.append(video_data)
+            for key, value in obj.items():
+                find_videos(value, f"{path}.{key}")
+        elif isinstance(obj, list):
+            for item in obj:
+                find_videos(item, path)
+
+    find_videos(data)
+    return videos
+
+def web_item(i):
+    return {
+        "id": str(7300000000000000000 + i), "desc": f"desc {i}", "createTime": 1700000000,
+        "author": {"id": f"66{i}", "uniqueId": f"user{i}", "nickname": "Nick"},
+        "music": {"id": "999", "title": "song"},
+        "video": {"id": str(i), "downloadAddr": "https://cdn.example/x", "cover": "c"},
+        "challenges": [{"id": "5", "title": "tag"}],
+        "stats": {"playCount": 1},
+    }
+
+def aweme_item(i):
+    return {
+        "aweme_id": str(7400000000000000000 + i), "desc": "x", "create_time": 1700000000,
+        "author": {"unique_id": f"a{i}", "nickname": "A", "uid": "3"},
+        "music": {"id": "9"}, "video": {"play_addr": {}},
+    }
+
+PAYLOADS = {
+    'web itemList': {"statusCode": 0, "itemList": [web_item(i) for i in range(30)],
+                     "musicInfo": {"music": {"id": "999"}, "author": {"id": "1"}}},
+    'aweme_list': {"data": {"aweme_list": [aweme_item(i) for i in range(30)]}},
+    'nested': {"payload": {"wrap": [{"entry": web_item(i)} for i in range(10)]}},
+}
+
+def real_ids(payload):
+    ids = set()
+    for items in (payload.get('itemList'), (payload.get('data') or {}).get('aweme_list')):
+        for item in items or []:
+            ids.add(item.get('id') or item.get('aweme_id'))
+    for entry in (payload.get('payload') or {}).get('wrap', []):
+        ids.add(entry['entry']['id'])
+    return ids
+
+def measure(extract, payload, repeat=200):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = extract(payload)
+    return result, (time.perf_counter() - started) / repeat * 1000
+
+def main_compare():
+    for name, payload in PAYLOADS.items():
+        ids = real_ids(payload)
+        for label, extract in (('старый', legacy_extract), ('новый', parsing.extract_from_json_structure)):
+            videos, ms = measure(extract, payload)
+            false_positives = sum(1 for video in videos if str(video['video_id']) not in ids)
+            print(f"{name:13} {label:6} записей {len(videos):4}  ложных {false_positives:4}  {ms:.3f} мс")
+
+    deep = current = {}
+    for _ in range(5000):
+        current['x'] = {}
+        current = current['x']
+    try:
+        legacy_extract(deep)
+        print("вложенность 5000: старый — без ошибки")
+    except RecursionError:
+        print("вложенность 5000: старый — RecursionError")
+    print(f"вложенность 5000: новый — {len(parsing.extract_from_json_structure(deep))} записей")
+
+if __name__ == '__main__':
+    main_compare()